@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+"""
+Measures the overhead of the judge with the stub isolate (see fake_isolate.py)
+
+Scenarios:
+judge       raw IsolatedJudge.new_job, all jobs submitted at once
+jobhelper   JobHelperInvokation run/wait/read_stdout/release, one after another (the way problem.py uses it)
+invocation  Invokation of python solutions on manual tests (needs g++ for the checker), until the grid is complete
+
+Every (scenario, engine, workers, tests) combination produces one JSON line
+appended to the output file, so runs of different revisions can be compared.
+
+Usage: bench_judge.py [--scenarios judge,jobhelper,invocation] [--engines threads,asyncio]
+                      [--workers 1,2,4] [--tests 20,100] [--solutions 3]
+                      [--init-delay 0.01] [--run-delay 0.005] [--cleanup-delay 0.01]
+                      [--output bench_output.txt]
+"""
+import sys, os, os.path
+import argparse
+import contextlib
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+
+def install_fake_isolate(tmpdir, args):
+    bindir = os.path.join(tmpdir, "bin")
+    os.makedirs(bindir)
+    with open(os.path.join(bindir, "isolate"), "w") as fp:
+        fp.write("#!/bin/sh\nexec {} {} \"$@\"\n".format(sys.executable, os.path.join(BENCH_DIR, "fake_isolate.py")))
+    os.chmod(os.path.join(bindir, "isolate"), 0o755)
+
+    os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_ISOLATE_ROOT"] = os.path.join(tmpdir, "boxes")
+    os.environ["FAKE_ISOLATE_INIT_DELAY"] = str(args.init_delay)
+    os.environ["FAKE_ISOLATE_RUN_DELAY"] = str(args.run_delay)
+    os.environ["FAKE_ISOLATE_CLEANUP_DELAY"] = str(args.cleanup_delay)
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summarize(timings):
+    """
+    timings: list of job.get_timings() dicts
+    """
+    res = dict()
+    for stage in ["queue_wait", "box_wait", "run", "handler"]:
+        values = [elem[stage] for elem in timings if stage in elem]
+        if values:
+            res[stage] = {"mean": sum(values) / len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95)}
+    return res
+
+def make_program(tmpdir):
+    path = os.path.join(tmpdir, "prog")
+    with open(path, "w") as fp:
+        fp.write("#!/bin/sh\nexec cat\n")
+    os.chmod(path, 0o755)
+
+    data = os.path.join(tmpdir, "input")
+    with open(data, "w") as fp:
+        fp.write("1 2\n")
+    return path, data
+
+def bench_judge(judge, tmpdir, tests):
+    prog, data = make_program(tmpdir)
+    judge.set_staging_dir(os.path.join(tmpdir, "stage"))
+
+    jobs = []
+    start = time.monotonic()
+    for i in range(tests):
+        env = judge.new_env()
+        env.add_exe_file(prog, "/prog")
+        job = judge.new_job(env, judge.new_limits(), "./prog", in_file=data)
+        job.set_quite()
+        jobs.append(job)
+
+    # boxes are returned on release, so release jobs as soon as they are done:
+    # there are fewer boxes than jobs
+    timings = []
+    for job in jobs:
+        job.wait()
+        timings.append(job.get_timings())
+        job.release()
+    return time.monotonic() - start, timings
+
+def bench_jobhelper(judge, tmpdir, tests):
+    prog, data = make_program(tmpdir)
+    judge.set_staging_dir(os.path.join(tmpdir, "stage"))
+
+    timings = []
+    start = time.monotonic()
+    for i in range(tests):
+        jh = judge.new_job_helper("invoke.g++")
+        jh.set_limits(judge.new_limits())
+        jh.run(prog, in_file=data)
+        jh.wait()
+        jh.read_stdout()
+        timings.append(jh.job.get_timings())
+        jh.release()
+    return time.monotonic() - start, timings
+
+def make_problem(tmpdir, tests, solutions):
+    home = os.path.join(tmpdir, "problem")
+    for sub in ["source", "solutions", "tests.manual"]:
+        os.makedirs(os.path.join(home, sub))
+
+    with open(os.path.join(home, "problem.cfg"), "w") as fp:
+        fp.write("[main]\nmodel_solution = sol0.py\ntime_limit = 1\nmemory_limit = 256\n")
+    with open(os.path.join(home, "check.cpp"), "w") as fp:
+        fp.write("int main() {\n    return 0;\n}\n")
+    for i in range(solutions):
+        with open(os.path.join(home, "solutions", "sol{}.py".format(i)), "w") as fp:
+            fp.write("import sys\nsys.stdout.write(sys.stdin.read())\n")
+
+    with open(os.path.join(home, "script.sh"), "w") as fp:
+        fp.write("#!/bin/bash\nfor i in $(seq 1 {}); do echo \":manual $i\"; done\n".format(tests))
+    for i in range(tests):
+        with open(os.path.join(home, "tests.manual", str(i + 1)), "w") as fp:
+            fp.write("{} {}\n".format(i, i + 1))
+    return home
+
+def bench_invocation(judge, tmpdir, tests, solutions):
+    import pmaker.problem
+    from pmaker.invocation_manager import new_invocation_manager
+
+    prob = pmaker.problem.new_problem(make_problem(tmpdir, tests, solutions))
+    prob.set_judge(judge)
+    prob.update_tests(interactive=False)
+
+    imanager = new_invocation_manager(prob, prob.relative("work", "invocations"))
+    sols = sorted(os.listdir(prob.relative("solutions")))
+
+    start = time.monotonic()
+    (uid, invocation) = imanager.new_invocation(judge, sols, list(range(1, tests + 1)))
+    invocation.start()
+    while not all(invocation.get_descriptor(i, j).is_final() for i in range(len(sols)) for j in range(tests)):
+        time.sleep(0.01)
+    return time.monotonic() - start, []
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="pmaker judge benchmark with the stub isolate")
+    parser.add_argument("--scenarios", default="judge,jobhelper,invocation")
+    parser.add_argument("--engines", default="threads,asyncio")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--tests", default="20,100")
+    parser.add_argument("--solutions", type=int, default=3)
+    parser.add_argument("--init-delay", type=float, default=0.01)
+    parser.add_argument("--run-delay", type=float, default=0.005)
+    parser.add_argument("--cleanup-delay", type=float, default=0.01)
+    parser.add_argument("--output", default="bench_output.txt")
+    args = parser.parse_args()
+
+    import pkg_resources
+    try:
+        pkg_resources.require("pmaker")
+    except pkg_resources.DistributionNotFound:
+        print("pmaker is not installed, please install it (e.g. pip install -e .)", file=sys.stderr)
+        return 1
+    from pmaker.judge import new_judge
+
+    revision = git_revision()
+    with open(args.output, "a") as out:
+        for scenario in args.scenarios.split(","):
+            for engine in args.engines.split(","):
+                for workers in map(int, args.workers.split(",")):
+                    for tests in map(int, args.tests.split(",")):
+                        tmpdir = tempfile.mkdtemp(prefix="pmaker-bench-")
+                        saved_path = os.environ["PATH"]
+                        try:
+                            install_fake_isolate(tmpdir, args)
+                            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                                with new_judge(threads=workers, compile_threads=1, engine=engine) as judge:
+                                    if scenario == "judge":
+                                        (elapsed, timings) = bench_judge(judge, tmpdir, tests)
+                                    elif scenario == "jobhelper":
+                                        (elapsed, timings) = bench_jobhelper(judge, tmpdir, tests)
+                                    elif scenario == "invocation":
+                                        (elapsed, timings) = bench_invocation(judge, tmpdir, tests, args.solutions)
+                                    else:
+                                        raise ValueError("Unknown scenario {}".format(scenario))
+                                    utilization = judge.get_utilization()
+                                boxes = judge._boxes.get_stats()
+                                handlers = judge._completions.get_stats()
+                        finally:
+                            os.environ["PATH"] = saved_path
+                            shutil.rmtree(tmpdir, ignore_errors=True)
+
+                        jobs = tests * args.solutions if scenario == "invocation" else tests
+                        record = {"timestamp": time.time(), "revision": revision, "scenario": scenario,
+                                  "engine": engine, "workers": workers, "tests": tests, "jobs": jobs,
+                                  "elapsed": elapsed, "jobs_per_sec": jobs / elapsed if elapsed > 0 else None,
+                                  "stages": summarize(timings), "boxes": boxes, "handlers": handlers, "utilization": utilization,
+                                  "delays": {"init": args.init_delay, "run": args.run_delay, "cleanup": args.cleanup_delay}}
+                        out.write(json.dumps(record) + "\n")
+                        out.flush()
+
+                        print("{:<10} {:<8} workers={:<3} tests={:<5} {:8.1f} jobs/sec".format(scenario, engine, workers, tests, record["jobs_per_sec"] or 0))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
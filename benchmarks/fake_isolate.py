@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+"""
+Stub of the isolate sandbox for benchmarking the judge.
+
+Supports --init, --run and --cleanup the way pmaker uses them (and --fsize), boxes are plain
+directories under $FAKE_ISOLATE_ROOT. Nothing is sandboxed: the command runs
+as the current user, /box and --dir mounts are emulated by rewriting paths.
+
+Environment:
+FAKE_ISOLATE_ROOT           where to keep the boxes (default /tmp/fake-isolate)
+FAKE_ISOLATE_INIT_DELAY     extra latency of --init, in seconds
+FAKE_ISOLATE_RUN_DELAY      extra latency of --run, in seconds
+FAKE_ISOLATE_CLEANUP_DELAY  extra latency of --cleanup, in seconds
+FAKE_ISOLATE_EXEC           "0" to skip running the command (reports success with empty output)
+"""
+import sys, os, os.path, shutil, subprocess, time, resource
+
+def delay(name):
+    time.sleep(float(os.environ.get("FAKE_ISOLATE_{}_DELAY".format(name), "0")))
+
+def parse(argv):
+    opts, dirs, command = dict(), [], []
+    for i in range(len(argv)):
+        arg = argv[i]
+        if arg == "--":
+            command = argv[i + 1:]
+            break
+        if arg.startswith("--dir="):
+            dirs.append(arg[len("--dir="):])
+        elif arg.startswith("--"):
+            (key, _, value) = arg[2:].partition("=")
+            opts[key] = value
+        else:
+            opts[arg] = ""
+    return opts, dirs, command
+
+def run(box, opts, dirs, command):
+    mounts = [("/box", box)]
+    for elem in dirs:
+        if "=" in elem:
+            (inside, outside) = elem.split("=", maxsplit=1)
+            mounts.append((inside.rstrip("/"), outside.split(":")[0]))
+
+    def outside(path):
+        if path.startswith("-I/"):
+            return "-I" + outside(path[2:])
+        for (inside, host) in mounts:
+            if path == inside or path.startswith(inside + "/"):
+                return host + path[len(inside):]
+        return path
+
+    # symlinks into --dir mounts (see pmaker.judge.StagingArea)
+    for (root, dirnames, filenames) in os.walk(box):
+        for name in dirnames + filenames:
+            path = os.path.join(root, name)
+            if os.path.islink(path) and os.readlink(path).startswith("/"):
+                target = outside(os.readlink(path))
+                os.remove(path)
+                os.symlink(target, path)
+
+    def redirect(key, mode):
+        if not opts.get(key):
+            return None
+        path = opts[key]
+        return open(outside(path) if path.startswith("/") else os.path.join(box, path), mode)
+
+    delay("RUN")
+    start = time.time()
+    if os.environ.get("FAKE_ISOLATE_EXEC", "1") == "0":
+        code = 0
+        for key in ["stdout", "stderr"]:
+            fp = redirect(key, "wb")
+            if fp:
+                fp.close()
+    else:
+        def limits():
+            if opts.get("fsize"):
+                size = 1024 * int(opts["fsize"])
+                resource.setrlimit(resource.RLIMIT_FSIZE, (size, size))
+
+        proc = subprocess.run([outside(arg) for arg in command], cwd=box, preexec_fn=limits,
+                              stdin=redirect("stdin", "rb"), stdout=redirect("stdout", "wb"), stderr=redirect("stderr", "wb"))
+        code = proc.returncode
+    elapsed = time.time() - start
+
+    meta = ["time:{:.3f}".format(elapsed), "time-wall:{:.3f}".format(elapsed), "cg-mem:1024", "max-rss:1024",
+            "csw-voluntary:1", "csw-forced:0"]
+    if code < 0:
+        meta += ["exitsig:{}".format(-code), "status:SG"]
+    else:
+        meta += ["exitcode:{}".format(code)]
+        if code != 0:
+            meta += ["status:RE"]
+
+    with open(opts["meta"], "w") as fp:
+        fp.write("\n".join(meta) + "\n")
+    return 0 if code == 0 else 1
+
+def main():
+    (opts, dirs, command) = parse(sys.argv[1:])
+    root = os.environ.get("FAKE_ISOLATE_ROOT", "/tmp/fake-isolate")
+    box  = os.path.join(root, opts.get("box-id", "0"))
+
+    if "cleanup" in opts:
+        delay("CLEANUP")
+        shutil.rmtree(box, ignore_errors=True)
+        return 0
+    if "init" in opts:
+        delay("INIT")
+        os.makedirs(os.path.join(box, "box"), exist_ok=True)
+        print(box)
+        return 0
+    if "run" in opts:
+        return run(os.path.join(box, "box"), opts, dirs, command)
+
+    print("fake isolate: unsupported command", file=sys.stderr)
+    return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
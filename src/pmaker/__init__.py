@@ -1,2 +1,2 @@
-__all__ = ["ui", "enter", "problem", "judge", "jobhelper", "invocation", "invocation_manager"]
+__all__ = ["ui", "enter", "problem", "judge", "graph", "async_judge", "direct", "jobhelper", "pch", "compile_cache", "digests", "jobindex", "snapshot", "forkserver", "invocation", "invocation_manager"]
 __version__ = __import__("pkg_resources").require("pmaker")[0].version
@@ -0,0 +1,257 @@
+import sys, os
+import asyncio
+import threading
+import queue
+import time
+
+from pmaker.judge import IsolatedJudge, IsolatedJob, SessionBox, StagingArea, BoxManager
+
+class AsyncBoxManager(BoxManager):
+    """
+    Same as judge.BoxManager, but boxes are prepared by the event loop
+    instead of background threads.
+
+    All the methods except release() and report() must be called from the loop.
+    """
+    def __init__(self, loop, box_ids):
+        self._loop    = loop
+        self._box_ids = list(box_ids)
+        self._ready   = asyncio.Queue()
+        self._tasks   = set()
+        self._lock    = threading.Lock()
+
+        # statistics, in seconds
+        self._num_prepared = 0
+        self._prepare_time = 0
+        self._wait_time    = 0
+
+        for box_id in self._box_ids:
+            self._start_recycle(box_id)
+
+    async def _isolate(self, *args, timeout=10):
+        proc = await asyncio.create_subprocess_exec("isolate", *args, stdout=asyncio.subprocess.PIPE)
+        try:
+            (out, _) = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+        if proc.returncode != 0:
+            raise Exception("isolate {} returned {}".format(" ".join(args), proc.returncode))
+        return out.decode()
+
+    async def _cleanup(self, box_id, timeout=10):
+        await self._isolate("--cleanup", "--cg", "--box-id={}".format(box_id), timeout=timeout)
+
+    async def _prepare(self, box_id):
+        await self._cleanup(box_id)
+        return (await self._isolate("--init", "--cg", "--box-id={}".format(box_id))).strip() + "/box"
+
+    async def _recycle(self, box_id):
+        start = self._loop.time()
+        workdir, error = None, None
+        try:
+            workdir = await self._prepare(box_id)
+        except Exception as ex:
+            error = str(ex)
+
+        with self._lock:
+            self._num_prepared += 1
+            self._prepare_time += self._loop.time() - start
+        self._ready.put_nowait((box_id, workdir, error))
+
+    def _start_recycle(self, box_id):
+        task = asyncio.ensure_future(self._recycle(box_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def acquire(self, timeout=None):
+        """
+        Returns (box_id, workdir, error) of the initialized box, see BoxManager.acquire
+        """
+        start = self._loop.time()
+        try:
+            return await asyncio.wait_for(self._ready.get(), timeout)
+        except asyncio.TimeoutError:
+            raise queue.Empty()
+        finally:
+            with self._lock:
+                self._wait_time += self._loop.time() - start
+
+    def release(self, box_id):
+        """
+        Thread-safe
+        """
+        self._loop.call_soon_threadsafe(self._start_recycle, box_id)
+
+    async def shutdown(self):
+        await asyncio.sleep(0) # let the pending release() calls schedule their tasks
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+        while not self._ready.empty():
+            (box_id, _, _) = self._ready.get_nowait()
+            try:
+                await self._cleanup(box_id, timeout=1)
+            except Exception as ex:
+                print("warning: failed to cleanup: {}".format(ex))
+
+class AsyncIsolatedJob(IsolatedJob):
+    """
+    IsolatedJob, driven by the event loop.
+
+    Besides the usual blocking interface, the job may be awaited
+    from the judge's loop: "await job" returns when the result is known.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._waiters = []
+
+    def _notify(self):
+        super()._notify()
+        with self._lock:
+            waiters = self._waiters
+            self._waiters = []
+
+        for (loop, fut) in waiters:
+            loop.call_soon_threadsafe(AsyncIsolatedJob._wake, fut)
+
+    @staticmethod
+    def _wake(fut):
+        if not fut.done():
+            fut.set_result(None)
+
+    def __await__(self):
+        loop = self._judge._loop
+        with self._lock:
+            fut = None
+            if self._result == None:
+                fut = loop.create_future()
+                self._waiters.append((loop, fut))
+
+        if fut != None:
+            yield from fut
+        return self
+
+    async def _awork(self, box_id, workdir, init_error=None, sbox=None):
+        try:
+            self._attach(box_id, workdir, init_error, sbox)
+            cmd = self._prepare_run(box_id)
+
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+            (out, _) = await proc.communicate()
+            self._finish_run(proc.returncode, out.decode())
+        except Exception as ex:
+            self._fail(ex)
+
+        # completion handlers block (files, release, new jobs), keep them off the loop,
+        # submit() itself may block while the handlers queue is full
+        await self._judge._loop.run_in_executor(None, self._judge._completions.submit, self._complete)
+
+class AsyncIsolatedJudge(IsolatedJudge):
+    """
+    IsolatedJudge with all the boxes driven by one asyncio event loop.
+
+    The loop runs on a background thread, so the judge has the same blocking
+    interface as IsolatedJudge (and problem/invocation code works unchanged),
+    but waiting for isolate doesn't cost a thread per box.
+    Only completion handlers run on threads, see judge.CompletionExecutor.
+
+    Needs python 3.8: before it, subprocesses can only be watched by the loop of the main thread.
+    """
+    JOB_CLASS = AsyncIsolatedJob
+
+    def _start(self):
+        if sys.version_info < (3, 8):
+            raise RuntimeError("The asyncio judge engine needs python 3.8 or newer")
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever)
+        self._loop_thread.start()
+        self._completions = self._new_completion_executor()
+
+        self.run_coroutine(self._astart()).result()
+
+    async def _astart(self):
+        self._queues  = {pool: asyncio.PriorityQueue() for pool in IsolatedJudge.POOLS}
+        self._boxes   = AsyncBoxManager(self._loop, self._box_ids())
+        self._workers = []
+        for pool in IsolatedJudge.POOLS:
+            for i in range(self._pool_size[pool]):
+                self._workers.append(asyncio.ensure_future(self._aworker(pool, self._new_worker_stats(pool))))
+
+    def run_coroutine(self, coro):
+        """
+        Schedules coroutine on the judge's loop, returns concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def _enqueue(self, pool, priority, job):
+        self._loop.call_soon_threadsafe(self._queues[pool].put_nowait, (priority, job))
+
+    async def _aworker(self, pool, stats):
+        while True:
+            job = (await self._queues[pool].get())[1]
+            if not self._running or job == None:
+                return
+            job._mark("dequeued")
+            if not job._start_running():
+                continue
+            start = time.monotonic()
+            if job._needs_box():
+                await job._awork(*(await self._aacquire_box(job._session)))
+            else:
+                await self._loop.run_in_executor(None, job._work, None, None)
+            with self._stats_lock:
+                stats[1] += time.monotonic() - start
+
+    async def _aacquire_box(self, session):
+        if session:
+            with self._session_lock:
+                if session._idle:
+                    sbox = session._idle.pop()
+                    del self._session_idle[sbox]
+                    return (sbox.box_id, sbox.workdir, None, sbox)
+
+        while True:
+            try:
+                (box_id, workdir, error) = await self._boxes.acquire(timeout=0.1)
+            except queue.Empty:
+                # boxes may be kept by idle sessions, take them back
+                self._evict_session_box()
+                continue
+
+            sbox = None
+            if session and workdir:
+                sbox = SessionBox(box_id, workdir, StagingArea(self._stage_root, box_id))
+            return (box_id, workdir, error, sbox)
+
+    async def _ashutdown(self):
+        for pool in IsolatedJudge.POOLS:
+            for i in range(self._pool_size[pool]):
+                self._queues[pool].put_nowait((-1000, None))
+        await asyncio.gather(*self._workers)
+        await self._loop.run_in_executor(None, self._completions.shutdown)
+
+        while self._evict_session_box():
+            pass
+
+        for pool in IsolatedJudge.POOLS:
+            while not self._queues[pool].empty():
+                job = self._queues[pool].get_nowait()[1]
+                if job != None:
+                    job._just_fail()
+
+        await self._boxes.shutdown()
+
+    def __exit__(self, *_):
+        print("shutting down judging system")
+        self._running = False
+        self.run_coroutine(self._ashutdown()).result()
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        if os.environ.get("PMAKER_JUDGE_STATS", "0") == "1":
+            print(self.report())
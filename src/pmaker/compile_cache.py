@@ -0,0 +1,273 @@
+"""
+Content-addressed cache of compiled binaries, shared by all the problems.
+
+The key is a hash of the source, the headers it includes, the compiler and
+the flags, so the same checker or solution is compiled once per user (or
+per host, or per team if the cache is on shared storage), whatever problem
+and path it comes from.
+
+Configuration (environment):
+PMAKER_COMPILE_CACHE       directory of the cache, "0" to disable,
+                           default is the "compiled" subdirectory of jobhelper.user_cache_dir()
+PMAKER_COMPILE_CACHE_SIZE  size limit in MB (default 1024), least recently used binaries are evicted
+"""
+
+import os, os.path
+import hashlib
+import re
+import shutil
+import subprocess
+import threading
+
+INCLUDE_DIRS = ["/usr/local/include", "/usr/include"]
+
+_INCLUDE_RE = re.compile(rb'^\s*#\s*include\s*([<"])([^>"]+)[>"]', re.MULTILINE)
+
+class DirectoryCacheBackend:
+    """
+    Cache entries are files root/<key[:2]>/<key>, modification time is the time of the last use.
+    The outputs of the compiler are stored next to the entry as root/<key[:2]>/<key>.<name>.
+
+    Safe to share between processes and hosts: entries are written to temporary files
+    and renamed, entries removed by someone else are just misses.
+    """
+    OUTPUTS = ["stdout", "stderr"]
+
+    def __init__(self, root, max_size):
+        self._root     = root
+        self._max_size = max_size
+        self._lock     = threading.Lock()
+        self._size     = None # estimated size of the cache, None if unknown
+
+    def _path(self, key):
+        return os.path.join(self._root, key[:2], key)
+
+    def open(self, key):
+        """
+        Returns the entry opened for reading, or None if there is no such entry.
+        The entry stays readable through the file even if it is evicted meanwhile.
+        """
+        path = self._path(key)
+        try:
+            fp = open(path, "rb")
+        except OSError:
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return fp
+
+    def read_output(self, key, name):
+        """
+        Returns the output (one of OUTPUTS) of the compiler stored with the entry, or None if there is none
+        """
+        try:
+            with open("{}.{}".format(self._path(key), name), "rb") as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def put(self, key, src, outputs=None):
+        """
+        Stores the file src and the outputs of the compiler (dict name -> path, see OUTPUTS) as the entry.
+        The parts missing from an existing entry are added.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # the entry itself goes last: it is complete once it exists
+        parts = [("{}.{}".format(path, name), outputs[name]) for name in DirectoryCacheBackend.OUTPUTS if name in (outputs or dict())]
+        added = 0
+        for (dest, part) in parts + [(path, src)]:
+            if os.path.exists(dest):
+                continue
+            tmp = "{}.tmp-{}-{}".format(dest, os.getpid(), threading.get_ident())
+            try:
+                shutil.copyfile(part, tmp)
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, dest)
+                added += os.path.getsize(dest)
+            except OSError:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                return
+
+        with self._lock:
+            if self._size != None:
+                self._size += added
+            if self._size == None or self._size > self._max_size:
+                self._evict()
+
+    def _entries(self):
+        """
+        Returns list of (mtime, size, paths) of the entries, paths are the entry and its outputs
+        """
+        res = dict()
+        for sub in os.listdir(self._root):
+            if len(sub) != 2 or not os.path.isdir(os.path.join(self._root, sub)):
+                continue
+            for name in os.listdir(os.path.join(self._root, sub)):
+                if ".tmp-" in name:
+                    continue
+                path = os.path.join(self._root, sub, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entry = res.setdefault(name.split(".")[0], [0, 0, []])
+                if not "." in name:
+                    entry[0] = st.st_mtime
+                entry[1] += st.st_size
+                entry[2].append(path)
+        return [tuple(elem) for elem in res.values()]
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache is 90% of the limit, under self._lock
+        """
+        entries = sorted(self._entries())
+        size = sum(elem[1] for elem in entries)
+        for (_, entry_size, paths) in entries:
+            if size <= self._max_size * 0.9:
+                break
+            # the entry first, so no one finds it without its outputs
+            for path in sorted(paths, key=len):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            size -= entry_size
+        self._size = size
+
+def _find_header(name, quoted, base):
+    dirs = ([base] if quoted else []) + INCLUDE_DIRS
+    for elem in dirs:
+        path = os.path.join(elem, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def source_files(source):
+    """
+    Returns the source and the headers it includes (recursively), real paths.
+
+    Only the headers found next to the source and in INCLUDE_DIRS are listed (e.g. testlib.h),
+    the headers of the compiler itself are covered by pmaker.pch.compiler_id().
+    """
+    res     = []
+    pending = [os.path.realpath(source)]
+    while pending:
+        path = pending.pop()
+        if path in res:
+            continue
+        res.append(path)
+
+        with open(path, "rb") as fp:
+            data = fp.read()
+        for (kind, name) in _INCLUDE_RE.findall(data):
+            header = _find_header(name.decode(errors="replace"), kind == b'"', os.path.dirname(path))
+            if header != None:
+                pending.append(os.path.realpath(header))
+    return res
+
+def header_files(name):
+    """
+    Returns the files of the header #include'd as <name> (see source_files()),
+    or empty list if it is not in INCLUDE_DIRS (e.g. headers of the compiler)
+    """
+    header = _find_header(name, False, None)
+    if header == None:
+        return []
+    return source_files(header)
+
+_search_lock = threading.Lock()
+_search_dirs = dict() # compiler_id() -> system_include_dirs()
+
+def system_include_dirs(compiler):
+    """
+    Returns the real paths of the directories the compiler searches for <headers> by default
+    (its own headers and the C library's), empty list if the compiler can't tell
+    """
+    import pmaker.pch
+
+    ident = pmaker.pch.compiler_id(compiler)
+    with _search_lock:
+        if ident in _search_dirs:
+            return _search_dirs[ident]
+
+    res = []
+    try:
+        output = subprocess.run([compiler, "-xc++", "-E", "-v", "-o", os.devnull, os.devnull], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    except OSError:
+        output = ""
+    inside = False
+    for line in output.split("\n"):
+        if line.startswith("#include <...> search starts here:"):
+            inside = True
+        elif line.startswith("End of search list."):
+            inside = False
+        elif inside and line.strip():
+            res.append(os.path.realpath(line.strip()))
+
+    with _search_lock:
+        _search_dirs[ident] = res
+        return res
+
+def source_digest(source):
+    """
+    Hash of the source and the headers it includes, see source_files()
+    """
+    hasher = hashlib.sha256()
+    for path in source_files(source):
+        with open(path, "rb") as fp:
+            hasher.update(hashlib.sha256(fp.read()).digest())
+    return hasher.hexdigest()
+
+def compile_key(source, compiler, flags):
+    """
+    Returns the cache key for compiling source with the compiler and flags
+    """
+    import pmaker.pch
+
+    parts = [pmaker.pch.compiler_id(compiler)] + list(flags) + [source_digest(source)]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+def toolchain_digest(compiler, flags):
+    """
+    Digest of the compiler identity, the C library version and flags
+    (a compile job's dependency besides the files, covers the headers in system_include_dirs())
+    """
+    import pmaker.pch
+
+    try:
+        ident = pmaker.pch.compiler_id(compiler)
+    except (OSError, subprocess.CalledProcessError):
+        ident = "{} unavailable".format(compiler)
+    try:
+        libc = os.confstr("CS_GNU_LIBC_VERSION") or ""
+    except (ValueError, OSError):
+        libc = ""
+    return hashlib.sha256("\0".join([ident, libc] + list(flags)).encode()).hexdigest()
+
+_cache_lock = threading.Lock()
+_cache      = None
+
+def get_compile_cache():
+    """
+    Returns the cache configured with the environment, or None if it is disabled
+    """
+    global _cache
+    with _cache_lock:
+        if _cache == None:
+            root = os.environ.get("PMAKER_COMPILE_CACHE")
+            if root == "0":
+                return None
+            if not root:
+                from pmaker.jobhelper import user_cache_dir
+                root = user_cache_dir("compiled")
+
+            os.makedirs(root, exist_ok=True)
+            _cache = DirectoryCacheBackend(root, int(os.environ.get("PMAKER_COMPILE_CACHE_SIZE", "1024")) * 1024 * 1024)
+        return _cache
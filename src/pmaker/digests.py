@@ -0,0 +1,109 @@
+import os, os.path
+import hashlib
+import mmap
+import sqlite3
+import threading
+import time
+import concurrent.futures
+
+NO_FILE = "_no_file_"
+
+# files modified this recently may change again within the same mtime, their digests are not cached
+RACY_NS = 2 * 10 ** 9
+
+_executor_lock = threading.Lock()
+_executor      = None
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor == None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+        return _executor
+
+def hash_file(path):
+    """
+    Returns sha256 of the file, read with mmap (hashlib releases the GIL, so files are hashed in parallel)
+    """
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return hashlib.sha256(data).hexdigest()
+
+class DigestDB:
+    """
+    Persistent cache of the file digests, keyed by (path, inode, size, mtime_ns),
+    so only the changed files are hashed again. Stored in sqlite (WAL mode, so several
+    pmaker processes may use it), if the database can't be opened, digests are only kept in memory.
+
+    Thread-safe.
+    """
+    def __init__(self, path):
+        self._lock   = threading.Lock()
+        self._memory = dict() # path -> ((inode, size, mtime_ns), digest)
+
+        try:
+            self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT)")
+            self._db.commit()
+        except sqlite3.Error:
+            self._db = None
+
+    def _lookup(self, path, key):
+        with self._lock:
+            if path in self._memory and self._memory[path][0] == key:
+                return self._memory[path][1]
+            if self._db == None:
+                return None
+
+            try:
+                row = self._db.execute("SELECT ino, size, mtime_ns, digest FROM digests WHERE path = ?", (path,)).fetchone()
+            except sqlite3.Error:
+                return None
+            if row == None or tuple(row[:3]) != key:
+                return None
+
+            self._memory[path] = (key, row[3])
+            return row[3]
+
+    def _store(self, path, key, digest):
+        with self._lock:
+            self._memory[path] = (key, digest)
+            if self._db == None:
+                return
+
+            try:
+                self._db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)", (path,) + key + (digest,))
+                self._db.commit()
+            except sqlite3.Error:
+                pass
+
+    def digest(self, path):
+        """
+        Returns sha256 of the file, or NO_FILE if it doesn't exist
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return NO_FILE
+
+        key    = (st.st_ino, st.st_size, st.st_mtime_ns)
+        digest = self._lookup(path, key)
+        if digest != None:
+            return digest
+
+        digest = hash_file(path)
+        if st.st_mtime_ns < int(time.time() * 1e9) - RACY_NS:
+            self._store(path, key, digest)
+        return digest
+
+    def digests(self, paths):
+        """
+        Returns the list of digests of the files, hashing them in parallel
+        """
+        if len(paths) <= 1:
+            return [self.digest(path) for path in paths]
+        return list(_get_executor().map(self.digest, paths))
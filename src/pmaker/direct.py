@@ -0,0 +1,389 @@
+import os, os.path
+import shutil
+import signal
+import resource
+import tempfile
+import threading
+import itertools
+import atexit
+
+from pmaker.judge import IsolatedJob, JobResult
+
+class CGroup:
+    """
+    cgroup v2 leaf for a single job.
+
+    All the jobs get their groups inside "pmaker-<pid>", created next to the
+    cgroup pmaker runs in. pmaker itself is moved to the leaf "pmaker-<pid>/self"
+    (cgroup v2 doesn't allow processes in the groups with controllers enabled for
+    the children). It only works if the memory and pids controllers can be delegated
+    there (e.g. the process runs in the root cgroup, or a systemd delegated one, alone),
+    otherwise create() returns None and jobs are limited with rlimits only.
+    """
+    _parent  = None
+    _checked = False
+    _warned  = False
+    _lock    = threading.Lock()
+    _counter = itertools.count()
+
+    @staticmethod
+    def _write(path, value):
+        with open(path, "w") as fp:
+            fp.write(value)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "r") as fp:
+            return fp.read()
+
+    @staticmethod
+    def warn(reason):
+        """
+        Prints the warning about the limits, which can't be enforced, once
+        """
+        if not CGroup._warned:
+            CGroup._warned = True
+            print("warning: direct jobs run without cgroup ({}), memory is limited with rlimits, processes are not limited".format(reason))
+
+    @staticmethod
+    def _setup_parent():
+        base = None
+        with open("/proc/self/cgroup", "r") as fp:
+            for line in fp.read().split("\n"):
+                if line.startswith("0::"):
+                    base = os.path.join("/sys/fs/cgroup", line[3:].lstrip("/"))
+        if base == None or not os.path.isfile(os.path.join(base, "cgroup.controllers")):
+            raise OSError("cgroup v2 is not mounted")
+
+        parent  = os.path.join(base, "pmaker-{}".format(os.getpid()))
+        enabled = []
+        os.mkdir(parent)
+        try:
+            os.mkdir(os.path.join(parent, "self"))
+            CGroup._write(os.path.join(parent, "self", "cgroup.procs"), str(os.getpid()))
+
+            controllers = CGroup._read(os.path.join(base, "cgroup.subtree_control")).split()
+            if not "memory" in controllers or not "pids" in controllers:
+                CGroup._write(os.path.join(base, "cgroup.subtree_control"), "+memory +pids")
+                enabled.append(base)
+            CGroup._write(os.path.join(parent, "cgroup.subtree_control"), "+memory +pids")
+        except OSError:
+            CGroup._remove_parent(base, parent, enabled)
+            raise
+
+        atexit.register(CGroup._remove_parent, base, parent, enabled)
+        return parent
+
+    @staticmethod
+    def _remove_parent(base, parent, enabled):
+        """
+        Moves pmaker back to base and removes the groups, as far as possible
+        """
+        for path in [parent] + enabled:
+            try:
+                CGroup._write(os.path.join(path, "cgroup.subtree_control"), "-memory -pids")
+            except OSError:
+                pass
+        try:
+            CGroup._write(os.path.join(base, "cgroup.procs"), str(os.getpid()))
+        except OSError:
+            pass
+        for path in [os.path.join(parent, "self"), parent]:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def create():
+        with CGroup._lock:
+            if not CGroup._checked:
+                CGroup._checked = True
+                try:
+                    CGroup._parent = CGroup._setup_parent()
+                except OSError as ex:
+                    CGroup._parent = None
+                    CGroup.warn(ex)
+
+        if CGroup._parent == None:
+            return None
+        try:
+            return CGroup(os.path.join(CGroup._parent, "job-{}".format(next(CGroup._counter))))
+        except OSError as ex:
+            CGroup.warn(ex)
+            return None
+
+    def __init__(self, path):
+        self.path = path
+        os.mkdir(path)
+
+    def set_limits(self, memorylimit=None, proclimit=None):
+        if memorylimit:
+            CGroup._write(os.path.join(self.path, "memory.max"), str(memorylimit * 1024))
+            try:
+                CGroup._write(os.path.join(self.path, "memory.swap.max"), "0")
+            except OSError:
+                pass # no swap accounting
+        if proclimit:
+            CGroup._write(os.path.join(self.path, "pids.max"), str(proclimit))
+
+    def add(self, pid):
+        """
+        Moves the process into the group
+        """
+        CGroup._write(os.path.join(self.path, "cgroup.procs"), str(pid))
+
+    def kill(self):
+        try:
+            CGroup._write(os.path.join(self.path, "cgroup.kill"), "1")
+        except OSError:
+            pass
+
+    def cpu_usage(self):
+        """
+        Returns cpu usage, in milliseconds
+        """
+        for line in CGroup._read(os.path.join(self.path, "cpu.stat")).split("\n"):
+            if line.startswith("usage_usec "):
+                return int(line.split()[1]) // 1000
+        return None
+
+    def memory_peak(self):
+        """
+        Returns memory peak, in kb's, or None if the kernel doesn't provide it
+        """
+        try:
+            return int(CGroup._read(os.path.join(self.path, "memory.peak"))) // 1024
+        except (OSError, ValueError):
+            return None
+
+    def oom_killed(self):
+        for line in CGroup._read(os.path.join(self.path, "memory.events")).split("\n"):
+            if line.startswith("oom_kill "):
+                return int(line.split()[1]) != 0
+        return False
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError as ex:
+            print("warning: failed to remove cgroup {}: {}".format(self.path, ex))
+
+class DirectJob(IsolatedJob):
+    """
+    Job, started directly by pmaker, without isolate.
+
+    Limits are enforced with setrlimit and, if possible, with the cgroup v2
+    leaf (memory, processes, precise cpu and peak memory accounting).
+    The job gets a new network namespace where supported, but it is not chrooted
+    and runs as the current user: use it for trusted programs only (generators,
+    validators, etc.)
+
+    Files are symlinked into the temporary working directory, which plays the role of /box.
+    """
+    def _needs_box(self):
+        return False
+
+    def _attach(self, box_id, workdir, init_error=None, sbox=None):
+        self._box_id = None
+        self._step = "init"
+        root = self._judge._stage_root
+        if root:
+            os.makedirs(root, exist_ok=True)
+        self._workdir = tempfile.mkdtemp(prefix="direct-", dir=root)
+        self._step = "run"
+        self._mark("started")
+
+    def _map_path(self, arg, mapping):
+        for (virtual, host) in mapping:
+            if arg == virtual or arg.startswith(virtual + "/"):
+                return host + arg[len(virtual):]
+        return arg
+
+    def _place(self, host, target, executable):
+        host = os.path.abspath(host)
+        if executable and not os.access(host, os.X_OK):
+            shutil.copyfile(host, target)
+            os.chmod(target, 0o755)
+        else:
+            os.symlink(host, target)
+
+    # the job waits for the barrier (its pipe is given by the number) before exec,
+    # so it is limited from the start: see _start()
+    BARRIER = 'read -r _ < /proc/self/fd/{} || exit 125; exec "$0" "$@"'
+    PATH    = "/usr/local/bin:/usr/bin/:/bin"
+
+    def _preexec(self):
+        # only syscalls here: the child of the multithreaded process mustn't take locks
+        if hasattr(os, "unshare") and hasattr(os, "CLONE_NEWNET"):
+            try:
+                os.unshare(os.CLONE_NEWNET)
+            except OSError:
+                pass
+
+    def _set_rlimits(self, pid, cgroup):
+        resource.prlimit(pid, resource.RLIMIT_CORE, (0, 0))
+        if self._limits:
+            if self._limits.timelimit:
+                secs = (self._limits.timelimit + 999) // 1000
+                resource.prlimit(pid, resource.RLIMIT_CPU, (secs, secs + 1))
+            if self._limits.memorylimit and not cgroup:
+                resource.prlimit(pid, resource.RLIMIT_AS, (self._limits.memorylimit * 1024, self._limits.memorylimit * 1024))
+            if self._limits.outputlimit:
+                resource.prlimit(pid, resource.RLIMIT_FSIZE, (self._limits.outputlimit * 1024, self._limits.outputlimit * 1024))
+
+    def _start(self, command, cgroup, **kwargs):
+        """
+        Starts the command, puts it to the cgroup and sets the rlimits before it is executed
+        """
+        import subprocess
+
+        if os.path.dirname(command[0]):
+            exe = os.path.join(kwargs.get("cwd", ""), command[0])
+        else:
+            exe = shutil.which(command[0], path=DirectJob.PATH)
+        if exe == None or not os.access(exe, os.X_OK):
+            raise FileNotFoundError("No such executable: {}".format(command[0]))
+
+        (barrier, release) = os.pipe()
+        try:
+            proc = subprocess.Popen(["/bin/sh", "-c", DirectJob.BARRIER.format(barrier)] + command, pass_fds=(barrier,),
+                                    start_new_session=True, env={"PATH": DirectJob.PATH}, preexec_fn=self._preexec, **kwargs)
+            os.close(barrier)
+            barrier = None
+
+            try:
+                if cgroup:
+                    cgroup.add(proc.pid)
+                self._set_rlimits(proc.pid, cgroup)
+            except OSError:
+                proc.kill()
+                proc.wait()
+                raise
+            os.write(release, b"\n")
+        finally:
+            if barrier != None:
+                os.close(barrier)
+            os.close(release) # the job exits without running the command, if it wasn't released
+        return proc
+
+    def _run(self, box_id):
+        from time import time
+
+        workdir = self._workdir
+        mapping = [("/box", workdir)]
+
+        if self._env:
+            for (tp, host, virtual) in self._env._get_instructions():
+                if tp == 0: # dir
+                    mapping.append((virtual.rstrip("/"), os.path.abspath(host)))
+                else:
+                    self._place(host, os.path.join(workdir, virtual[1:]), executable=(tp == 2))
+
+        os.mkdir(os.path.join(workdir, "_files"))
+        for fl in ["stdin", "stdout", "stderr"]:
+            with open(os.path.join(workdir, "_files", fl), "w") as f:
+                pass
+        stdin_path = self._in_file if self._in_file else os.path.join(workdir, "_files", "stdin")
+
+        command = [self._map_path(arg, mapping) for arg in self._command]
+
+        cgroup = CGroup.create()
+        if cgroup:
+            try:
+                cgroup.set_limits(memorylimit=self._limits.memorylimit if self._limits else None,
+                                  proclimit=self._limits.proclimit if self._limits else None)
+            except OSError as ex:
+                CGroup.warn(ex)
+                cgroup.remove()
+                cgroup = None
+
+        if not self._quite:
+            if self._userdesc:
+                print("direct-run [{}]".format(self._userdesc))
+            else:
+                print("direct-run")
+
+        wall_killed = [False]
+        try:
+            with open(stdin_path, "rb") as fin, open(os.path.join(workdir, "_files", "stdout"), "wb") as fout, open(os.path.join(workdir, "_files", "stderr"), "wb") as ferr:
+                start = time()
+                proc = self._start(command, cgroup, cwd=workdir, stdin=fin, stdout=fout, stderr=ferr)
+
+            def kill():
+                wall_killed[0] = True
+                if cgroup:
+                    cgroup.kill()
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+            timer = None
+            if self._limits and self._limits.timelimit_wall:
+                timer = threading.Timer(self._limits.timelimit_wall / 1000, kill)
+                timer.start()
+
+            (_, status, rusage) = os.wait4(proc.pid, 0)
+            self._wallusage = int(1000 * (time() - start))
+            proc.returncode = status # already reaped, don't let Popen wait for it
+            if timer:
+                timer.cancel()
+
+            # leftovers in the process group
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+            self._timeusage = int(1000 * (rusage.ru_utime + rusage.ru_stime))
+            self._memusage  = rusage.ru_maxrss # kb's
+            oom = False
+            if cgroup:
+                self._timeusage = cgroup.cpu_usage() or self._timeusage
+                self._memusage  = cgroup.memory_peak() or self._memusage
+                oom = cgroup.oom_killed()
+        finally:
+            if cgroup:
+                cgroup.remove()
+
+        self._telemetry = {"time": self._timeusage, "time_wall": self._wallusage, "max_rss": rusage.ru_maxrss,
+                           "csw_voluntary": rusage.ru_nvcsw, "csw_forced": rusage.ru_nivcsw,
+                           "killed": wall_killed[0], "oom_killed": oom}
+        if cgroup:
+            self._telemetry["cg_mem"] = self._memusage
+        if os.WIFSIGNALED(status):
+            self._telemetry["exitsig"] = os.WTERMSIG(status)
+        else:
+            self._telemetry["exitcode"] = os.WEXITSTATUS(status)
+
+        TL = self._limits.timelimit if self._limits else None
+        ML = self._limits.memorylimit if self._limits else None
+
+        if os.WIFSIGNALED(status):
+            self._exitsig = str(os.WTERMSIG(status))
+            self._result = JobResult.SG
+            if os.WTERMSIG(status) == signal.SIGXCPU:
+                self._result = JobResult.TL
+        else:
+            self._exitcode = os.WEXITSTATUS(status)
+            self._result = JobResult.OK if self._exitcode == 0 else JobResult.RE
+
+        if wall_killed[0] or (TL and self._timeusage > TL):
+            self._result = JobResult.TL
+        elif self._output_exceeded():
+            self._result = JobResult.OL
+        elif oom or (ML and not cgroup and self._result != JobResult.OK and self._memusage >= ML):
+            self._result = JobResult.ML
+
+        self._notify()
+
+    def release(self):
+        """
+        Releases job and destroys all result
+        """
+        if hasattr(self, "_box_id"):
+            self.wait()
+            if self._workdir:
+                shutil.rmtree(self._workdir, ignore_errors=True)
+            delattr(self, "_box_id")
@@ -7,6 +7,69 @@ def error(msg):
 
 help_info = []
 commands_list = []
+global_options = dict()
+
+def _positive(value):
+    res = int(value)
+    if res <= 0:
+        raise ValueError("not positive")
+    return res
+
+def _engine(value):
+    if not value in ["threads", "asyncio"]:
+        raise ValueError("unknown engine")
+    return value
+
+def judge_options(prob=None):
+    """
+    Returns keyword arguments for new_judge, or None if some value is bad (the error is printed)
+
+    Command line options override environment (PMAKER_THREADS, PMAKER_COMPILE_THREADS, PMAKER_ENGINE),
+    environment overrides [judge] section of problem.cfg.
+    """
+    res = dict()
+    for (key, option, env, conv) in [("threads", "--threads", "PMAKER_THREADS", _positive),
+                                     ("compile_threads", "--compile-threads", "PMAKER_COMPILE_THREADS", _positive),
+                                     ("engine", "--engine", "PMAKER_ENGINE", _engine)]:
+        (value, source) = (None, None)
+        if prob != None and prob.get_judge_option(key) != None:
+            (value, source) = (prob.get_judge_option(key), "{} in [judge]".format(key))
+        if env in os.environ:
+            (value, source) = (os.environ[env], env)
+        if key in global_options:
+            (value, source) = (global_options[key], option)
+
+        if value != None:
+            try:
+                res[key] = conv(value)
+            except ValueError:
+                print("Bad value for {}: {}".format(source, value))
+                return None
+    return res
+
+def parse_global_options(argv):
+    """
+    Parses options preceding the command, returns the rest of argv
+    """
+    while len(argv) != 0:
+        if argv[0] == "-j" and len(argv) >= 2:
+            global_options["threads"] = argv[1]
+            argv = argv[2:]
+        elif argv[0].startswith("-j") and argv[0] != "-j":
+            global_options["threads"] = argv[0][2:]
+            argv = argv[1:]
+        elif argv[0].startswith("--threads="):
+            global_options["threads"] = argv[0].split("=", maxsplit=1)[1]
+            argv = argv[1:]
+        elif argv[0].startswith("--compile-threads="):
+            global_options["compile_threads"] = argv[0].split("=", maxsplit=1)[1]
+            argv = argv[1:]
+        elif argv[0].startswith("--engine="):
+            global_options["engine"] = argv[0].split("=", maxsplit=1)[1]
+            argv = argv[1:]
+        else:
+            break
+    return argv
 
 def cmd(want=[], arg=None, manual=None, long_help=None):
     def wrapper(f):
@@ -51,7 +114,10 @@ def cmd(want=[], arg=None, manual=None, long_help=None):
             
             if feature == "judge":
                 from pmaker.judge import new_judge
-                with new_judge() as judge:
+                options = judge_options(__kwargs.get("prob"))
+                if options == None:
+                    return 1
+                with new_judge(**options) as judge:
                     __kwargs["judge"] = judge
                     return new_func(argv, __ptr=__ptr+1, __kwargs=__kwargs)
 
@@ -86,8 +152,13 @@ def cmd_tests(prob=None, judge=None):
      manual="Invoke specified solutions",
      long_help="""Invokes the specified solutions
 
-Usage: pmaker invoke [list-of-solutions],
-or     pmaker invoke @all
+Usage: pmaker invoke [options] [list-of-solutions],
+or     pmaker invoke [options] @all
+
+Options:
+  --stop-group-on-fail  stop testing the solution on a group after the first non-OK verdict in it
+  --max-failures=N      stop testing the solution after N non-OK verdicts
+The tests not run are marked SKIPPED.
 
 You will probably want to run "pmaker tests" prior this command.
 
@@ -96,6 +167,22 @@ See also http://localhost:8128/invocation for invocation list
 """)
 def cmd_invoke(prob=None, imanager=None, judge=None, ui=None, argv=None):
     import threading
+    from pmaker.invocation import InvokationPolicy
+
+    policy = InvokationPolicy()
+    while len(argv) != 0 and argv[0].startswith("--"):
+        if argv[0] == "--stop-group-on-fail":
+            policy.stop_group_on_fail = True
+        elif argv[0].startswith("--max-failures="):
+            try:
+                policy.max_failures = int(argv[0].split("=", maxsplit=1)[1])
+            except ValueError:
+                print("Bad value for --max-failures: {}".format(argv[0]))
+                return 1
+        else:
+            print("Unknown option {}".format(argv[0]))
+            return 1
+        argv = argv[1:]
 
     prob.set_judge(judge)    
     solutions = argv
@@ -106,7 +193,7 @@ def cmd_invoke(prob=None, imanager=None, judge=None, ui=None, argv=None):
         solutions = os.listdir(prob.relative("solutions"))
         solutions.sort()
     
-    uid, invocation = imanager.new_invocation(judge, solutions, test_indices)
+    uid, invocation = imanager.new_invocation(judge, solutions, test_indices, policy=policy)
     ithread = threading.Thread(target=invocation.start)
     ithread.start()
             
@@ -145,7 +232,10 @@ def cmd_run(prob=None, argv=None):
 
     if need_compile:
         from pmaker.judge import new_judge
-        with new_judge() as judge:
+        options = judge_options(prob)
+        if options == None:
+            return 1
+        with new_judge(**options) as judge:
             prob.set_judge(judge)
             prob.compile("solutions", sol)
     
@@ -206,6 +296,8 @@ def cmd_help(argv=None):
     print("")
     print("Usage:")
     print("======")
+    print("pmaker [-j <threads>] [--compile-threads=<threads>] [--engine=threads|asyncio] <command> [args]")
+    print("")
 
     max_cmd = 0
     for (cmd, desc, hlp) in help_info:
@@ -309,7 +401,7 @@ global {
 
 def main():
     try:
-        argv = sys.argv[1:]
+        argv = parse_global_options(sys.argv[1:])
         if len(argv) == 0:
             argv = ["--help"]
 
@@ -0,0 +1,113 @@
+"""
+Fork-server for python generators, runs inside the sandbox (see jobhelper.JobHelperPyBatch).
+
+Usage: python3 -S forkserver.py <zipapp> <batch.json>
+
+The generator (zipapp made by JobHelperPyCompilation) is loaded and the modules
+it imports are imported once, then the server forks a child per test, which runs
+the generator as __main__ with the test's argv and stdout (stdin is empty).
+Children run one at a time, so the sandbox limits apply to one test at a time.
+
+batch.json: {"tests": [{"args": [...], "stdout": path}, ...],
+             "timelimit": cpu seconds per test, "timelimit_wall": seconds per test}
+
+Writes {"codes": [exit code, or -signal, per test]} to results.json.
+
+Only the standard library may be used here: pmaker is not available in the sandbox.
+"""
+import sys, os
+import dis
+import json
+import marshal
+import resource
+import signal
+import traceback
+import zipfile
+
+def load_code(path):
+    with zipfile.ZipFile(path) as zf:
+        data = zf.read("__main__.pyc")
+    # header of the .pyc, see jobhelper.JobHelperPyCompilation
+    return marshal.loads(data[16 if sys.version_info >= (3, 7) else 12:])
+
+def preload(code):
+    """
+    Imports the modules the code imports (at any depth), ignoring failures
+    """
+    for instr in dis.get_instructions(code):
+        if instr.opname == "IMPORT_NAME":
+            try:
+                __import__(instr.argval)
+            except Exception:
+                pass
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            preload(const)
+
+def run_child(code, path, test, timelimit, timelimit_wall):
+    if timelimit:
+        resource.setrlimit(resource.RLIMIT_CPU, (timelimit, timelimit + 1))
+    if timelimit_wall:
+        signal.alarm(timelimit_wall)
+
+    fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(fd, 0)
+    fd = os.open(test["stdout"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(fd, 1)
+
+    sys.stdin  = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", closefd=False)
+    sys.argv   = [path] + test["args"]
+
+    code_ = 0
+    try:
+        exec(code, {"__name__": "__main__", "__file__": path, "__builtins__": __builtins__})
+    except SystemExit as ex:
+        if ex.code == None:
+            code_ = 0
+        elif isinstance(ex.code, int):
+            code_ = ex.code
+        else:
+            print(ex.code, file=sys.stderr)
+            code_ = 1
+    except BaseException:
+        traceback.print_exc()
+        code_ = 1
+
+    try:
+        sys.stdout.flush()
+    except Exception:
+        code_ = code_ or 1
+    os._exit(code_)
+
+def main(argv):
+    (path, batch) = argv
+    with open(batch) as fp:
+        batch = json.load(fp)
+
+    code = load_code(path)
+    preload(code)
+
+    codes = []
+    for test in batch["tests"]:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_child(code, path, test, batch.get("timelimit"), batch.get("timelimit_wall"))
+            finally:
+                os._exit(1)
+
+        (_, status) = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            codes.append(-os.WTERMSIG(status))
+        else:
+            codes.append(os.WEXITSTATUS(status))
+
+    with open("results.json", "w") as fp:
+        json.dump({"codes": codes}, fp)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,113 @@
+import heapq
+import itertools
+import concurrent.futures
+
+class JobGraph:
+    """
+    Graph of dependent tasks, e.g. generator -> validator -> model answer for each test.
+
+    Tasks are plain callables, run on host threads (usually they block on judge jobs),
+    a task is started as soon as all it's dependencies are complete.
+    Among the ready tasks the one with the longest chain of work after it (critical path)
+    goes first, at most width tasks run at once, use judge.get_capacity() to keep the judge busy.
+
+    If some task fails, no new tasks are started, the running ones are waited
+    and the first exception is reraised from run().
+    """
+    def __init__(self, width=1):
+        self._width    = max(1, width)
+        self._nodes    = dict()
+        self._order    = itertools.count()
+
+    class Node:
+        def __init__(self, key, func, weight, c_handler, order):
+            self.key       = key
+            self.func      = func
+            self.weight    = weight
+            self.c_handler = c_handler
+            self.order     = order
+            self.deps      = []
+            self.children  = []
+            self.rank      = None
+
+    def add(self, key, func, deps=(), weight=1, c_handler=None):
+        """
+        Adds the task, unless task with the same key is already present.
+
+        key: hashable id of the task
+        func: callable, it's result is returned from run()
+        deps: keys of the tasks, which must be complete before this one, must be added before
+        weight: estimated cost of the task (relative), used to find the critical path
+        c_handler: optional callable(key, result), called from run()'s thread when the task is complete
+
+        Returns key.
+        """
+        if key in self._nodes:
+            return key
+
+        node = JobGraph.Node(key, func, weight, c_handler, next(self._order))
+        for dep in deps:
+            if dep == None:
+                continue
+            if not dep in self._nodes:
+                raise KeyError("Unknown dependency {}".format(dep))
+            if not dep in node.deps:
+                node.deps.append(dep)
+                self._nodes[dep].children.append(node)
+
+        self._nodes[key] = node
+        return key
+
+    def __contains__(self, key):
+        return key in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _compute_ranks(self):
+        # dependencies are always added before the node, so reversed insertion order is a reversed topological order
+        for node in sorted(self._nodes.values(), key=lambda node: -node.order):
+            node.rank = node.weight + max([child.rank for child in node.children], default=0)
+
+    def run(self):
+        """
+        Runs all the tasks, returns dict key -> result
+        """
+        self._compute_ranks()
+
+        waiting = {key: len(node.deps) for (key, node) in self._nodes.items()}
+        ready   = [(-node.rank, node.order, node) for node in self._nodes.values() if not node.deps]
+        heapq.heapify(ready)
+
+        results = dict()
+        error   = None
+        running = dict()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._width) as executor:
+            while ready or running:
+                while ready and error == None and len(running) < self._width:
+                    node = heapq.heappop(ready)[2]
+                    running[executor.submit(node.func)] = node
+
+                if not running:
+                    break
+
+                (done, _) = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    node = running.pop(fut)
+                    try:
+                        results[node.key] = fut.result()
+                    except Exception as ex:
+                        if error == None:
+                            error = ex
+                        continue
+
+                    if node.c_handler:
+                        node.c_handler(node.key, results[node.key])
+                    for child in node.children:
+                        waiting[child.key] -= 1
+                        if waiting[child.key] == 0:
+                            heapq.heappush(ready, (-child.rank, child.order, child))
+
+        if error != None:
+            raise error
+        return results
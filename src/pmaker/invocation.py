@@ -1,8 +1,11 @@
 from enum import IntEnum
 import json
 import os, os.path
+import threading
+import concurrent.futures
 
 class InvokationStatus(IntEnum):
+    SKIPPED    = -10 # not run, see InvokationPolicy
     INCOMPLETE = -9
     WAITING    = -8
     COMPILING  = -7
@@ -26,6 +29,7 @@ class InvokationStatus(IntEnum):
     TL_ML     =  9  # well, whatever.
     
     TL        =  10 # TL (HARD edition)
+    OL        =  11 # output limit exceeded
 
     def make_tl(self, ignore_fail=False):
         if InvokationStatus.OK <= self <= InvokationStatus.ML:
@@ -49,6 +53,23 @@ class InvokationStatus(IntEnum):
         raise ValueError("Can't remove TL from verdict")
 
 
+class InvokationPolicy:
+    """
+    When to stop testing a solution early, the cells not run are SKIPPED.
+
+    stop_group_on_fail: after the first non-OK verdict in a group, skip the rest of the group.
+    max_failures: after that many non-OK verdicts, skip the rest of the solution's tests.
+    """
+    def __init__(self, stop_group_on_fail=False, max_failures=None):
+        self.stop_group_on_fail = stop_group_on_fail
+        self.max_failures       = max_failures
+
+    def export(self):
+        return {"stop_group_on_fail": self.stop_group_on_fail, "max_failures": self.max_failures}
+
+    def is_trivial(self):
+        return not self.stop_group_on_fail and not self.max_failures
+
 class InvokeDesc:
     def __init__(self, invocation, limits, sol_no, solution, test_no, export):
         self.invocation = invocation
@@ -61,9 +82,11 @@ class InvokeDesc:
         self.export     = export
         self.the_test   = self.prob.get_testset().by_index(self.test_no)
         self.state      = 0 # not started.
+        self.starting   = False
         
         self.totaltime = None
         self.totalmem  = None
+        self.telemetry = None
 
     def redump(self):
         try:
@@ -73,6 +96,8 @@ class InvokeDesc:
                     db["time_usage"] = self.totaltime
                 if self.totalmem:
                     db["mem_usage"] = self.totalmem
+                if self.telemetry:
+                    db["telemetry"] = self.telemetry
                 if self.state == 3:
                     db["result"]    = self.result.name
                 json.dump(db, fp)
@@ -80,21 +105,53 @@ class InvokeDesc:
             pass
             
     def start(self, is_ce=False):
+        with self.invocation.cells_lock:
+            if self.state == 3: # skipped already
+                return
+
         if is_ce:
             self.result = InvokationStatus.CE
             self.state = 3
             self.redump()
+            self.invocation._cell_done(self)
             return
-        
+
+        # the input may have to be generated, and submitting the job may block: not under the lock
         jobhelper = self.judge.new_job_helper("invoke.g++")
         jobhelper.set_limits(self.limits)
+        jobhelper.set_session(self.invocation.get_session(self.sol_no))
 
         the_input = self.prob.relative("work", "_data", self.prob.get_test_input_data(self.the_test))
 
-        self.jobhelper = jobhelper
+        with self.invocation.cells_lock:
+            if self.state == 3: # skipped meanwhile
+                return
+            self.jobhelper = jobhelper
+            self.state = 1 # testing
+            self.starting = True # can't be cancelled until submitted
+
         jobhelper.run(self.invocation.relative("compilations", "{}".format(self.sol_no)), in_file=the_input, c_handler=self.invoke_done)
+        with self.invocation.cells_lock:
+            self.starting = False
+
+    def skip(self):
+        """
+        Marks the cell SKIPPED, unless it's solution is already running, returns True on success
+        """
+        with self.invocation.cells_lock:
+            if self.state == 0:
+                pass
+            elif self.state == 1 and not self.starting and self.jobhelper.cancel():
+                self.jobhelper.release()
+            else:
+                return False
 
-        self.state = 1 # testing
+            self.result = InvokationStatus.SKIPPED
+            self.state = 3
+
+        self.redump()
+        self.invocation._cell_done(self)
+        return True
 
     def invoke_done(self):
         rs = self.jobhelper.result()
@@ -102,11 +159,11 @@ class InvokeDesc:
         
         self.totaltime = self.jobhelper.get_timeusage()
         self.totalmem  = self.jobhelper.get_memusage()
+        self.telemetry = self.jobhelper.get_telemetry()
 
-        with open(self.invocation.relative("output", self.export), "w") as fp:
-            fp.write(self.jobhelper.read_stdout())
-        with open(self.invocation.relative("output", self.export + "_err"), "w") as fp:
-            fp.write(self.jobhelper.read_stderr())
+        capture = Invokation.OUTPUT_CAPTURE if rs == JobResult.OL else None
+        self.jobhelper.fetch_stdout(self.invocation.relative("output", self.export), capture=capture)
+        self.jobhelper.fetch_stderr(self.invocation.relative("output", self.export + "_err"), capture=Invokation.OUTPUT_CAPTURE)
         if self.jobhelper.is_ok_or_re():
             with open(self.invocation.relative("output", self.export + "_code"), "w") as fp:
                 fp.write(str(self.jobhelper.exit_code()))
@@ -116,6 +173,7 @@ class InvokeDesc:
             self.state = 3 # complete
             self.jobhelper.release()
             self.redump()
+            self.invocation._cell_done(self)
             return
         
         if rs in [JobResult.RE, JobResult.SG]:
@@ -123,13 +181,23 @@ class InvokeDesc:
             self.state = 3 # complete
             self.jobhelper.release()
             self.redump()
+            self.invocation._cell_done(self)
+            return
+
+        if rs in [JobResult.OL]:
+            self.result = InvokationStatus.OL
+            self.state = 3 # complete
+            self.jobhelper.release()
+            self.redump()
+            self.invocation._cell_done(self)
             return
 
         if rs in [JobResult.ML]:
             self.result = InvokationStatus.ML
             self.state = 3 # complete
             self.jobhelper.release()
-            self.redump()            
+            self.redump()
+            self.invocation._cell_done(self)
             return
 
         if rs in [JobResult.FL]:
@@ -138,6 +206,7 @@ class InvokeDesc:
             self.state = 3 # complete
             self.jobhelper.release()
             self.redump()
+            self.invocation._cell_done(self)
             return
                         
         self.jobhelper.release()
@@ -149,6 +218,7 @@ class InvokeDesc:
         the_output = self.prob.relative("work", "_data", self.prob.get_test_output_data(self.the_test))
         
         jobhelper.set_priority(30)
+        jobhelper.set_session(self.invocation.get_session(None))
         jobhelper.add_file(the_input, "/input")
         jobhelper.add_file(the_output, "/correct")
         jobhelper.add_file(self.invocation.relative("output", self.export), "/output")
@@ -175,11 +245,7 @@ class InvokeDesc:
                 code = self.jobhelper.exit_code()
                 self.result = self.prob.parse_exit_code(code)
 
-            try:
-                with open(self.invocation.relative("output", self.export + "_check"), "w") as fp:
-                    fp.write(self.jobhelper.read_stderr())
-            except:
-                raise
+            self.jobhelper.fetch_stderr(self.invocation.relative("output", self.export + "_check"))
         
         if rs.ok_or_re():
             try:
@@ -192,6 +258,7 @@ class InvokeDesc:
         self.state = 3
         self.redump()
         self.jobhelper.release()
+        self.invocation._cell_done(self)
 
     def is_final(self):
         return self.state == 3
@@ -207,23 +274,33 @@ class InvokeDesc:
         if self.state == 2:
             return InvokationStatus.CHECKING
         
-        if self.totaltime >= self.invocation.timelimit:
+        if self.totaltime != None and self.totaltime >= self.invocation.timelimit:
             return self.result.make_tl(ignore_fail=True)
         else:
             return self.result
     
     def get_rusage(self):
         return (self.totaltime, self.totalmem)
+
+    def get_telemetry(self):
+        """
+        Returns the sandbox report on the solution's run (see IsolatedJob.get_telemetry()), or None
+        """
+        return self.telemetry
     
 class Invokation:
     def relative(self, *args):
         return os.path.join(self.workdir, *args)
     
-    def __init__(self, judge, prob, solutions, test_indices, uid, path, TL, ML):
+    # bytes of the output kept from both ends, if the solution exceeded the output limit
+    OUTPUT_CAPTURE = 64 * 1024
+
+    def __init__(self, judge, prob, solutions, test_indices, uid, path, TL, ML, policy=None, OL=None):
         self.judge        = judge
         self.prob         = prob
         self.solutions    = solutions
         self.test_indices = test_indices
+        self.policy       = policy if policy else InvokationPolicy()
 
         self.workdir = path
 
@@ -231,7 +308,9 @@ class Invokation:
             json.dump({"solutions": self.solutions,
                        "test_indices": self.test_indices,
                        "timelimit": TL,
-                       "memorylimit": ML},
+                       "memorylimit": ML,
+                       "outputlimit": OL,
+                       "policy": self.policy.export()},
                       fp)
 
         os.makedirs(self.relative("results"))
@@ -240,18 +319,53 @@ class Invokation:
         
         self.timelimit   = TL
         self.memorylimit = ML
+        self.outputlimit = OL
         
         self.compilation_jobs    = [None for i in range(len(solutions))]
+        self.reused              = [False for i in range(len(solutions))] # taken from the problem's compilation cache
+
+        # one session per solution (to run it's binary) and one for the checker
+        self.sessions       = [self.judge.new_session() for i in range(len(solutions))]
+        self.check_session  = self.judge.new_session()
+        self.cells_left     = [len(test_indices) for i in range(len(solutions))]
+        self.cells_lock     = threading.RLock()
+        self.failures       = [0 for i in range(len(solutions))]
+        
+        if len(solutions) == 0 or len(test_indices) == 0:
+            self.__close_sessions()
 
         limits = self.judge.new_limits()
         limits.set_timelimit(2 * TL)
         limits.set_timelimit_wall(3 * TL)
         limits.set_memorylimit(ML)
+        limits.set_outputlimit(OL)
         
         self.descriptors        = [[InvokeDesc(self, limits, i, solutions[i], test_indices[j], export="{}_{}".format(i, j)) for j in range(len(test_indices))] for i in range(len(solutions))]
         
+    def _reuse_compilation(self, i):
+        """
+        Links the binary from the problem's compilation cache, if it's up to date, returns True on success
+        """
+        from pmaker.problem import ProblemError
+        from pmaker.jobhelper import fetch_file, JobHelperDumb
+
+        try:
+            self.prob.compile("solutions", self.solutions[i], check_only=True)
+            fetch_file(self.prob.compile_result("solutions", self.solutions[i]), self.relative("compilations", "{}".format(i)))
+        except (ProblemError, OSError):
+            return False
+
+        with open(self.relative("compilations", "{}_code".format(i)), "w") as fp:
+            fp.write("0")
+        self.compilation_jobs[i] = JobHelperDumb(self.judge)
+        self.reused[i] = True
+        return True
+
     def start(self):
         for i in range(len(self.solutions)):
+            if self._reuse_compilation(i):
+                continue
+
             limits = self.judge.new_limits()
             limits.set_timelimit(30 * 1000)
             limits.set_timelimit_wall(45 * 1000)
@@ -261,6 +375,7 @@ class Invokation:
             job_this = None
             if self.solutions[i].endswith(".py"):
                 job_this = self.judge.new_job_helper("compile.py3")
+                job_this.set_interpreter(self.prob.get_python())
             else:
                 job_this = self.judge.new_job_helper("compile.g++")
             
@@ -269,25 +384,82 @@ class Invokation:
             job_this.run(self.prob.relative("solutions", self.solutions[i]))
             self.compilation_jobs[i] = job_this
 
-        for i in range(len(self.solutions)):
-            self.compilation_jobs[i].wait()
-            if self.compilation_jobs[i].is_ok_or_re():
-                with open(self.relative("compilations", "{}_out".format(i)), "w") as fp:
-                    fp.write(self.compilation_jobs[i].read_stdout())
-                with open(self.relative("compilations", "{}_err".format(i)), "w") as fp:
-                    fp.write(self.compilation_jobs[i].read_stderr())
-                with open(self.relative("compilations", "{}_code".format(i)), "w") as fp:
-                    fp.write(str(self.compilation_jobs[i].exit_code()))
+        # post-process compilations in the order they finish, releasing their boxes early,
+        # and queue the solution's tests right away, while the other solutions are still compiling
+        futures = {self.compilation_jobs[i].future(): i for i in range(len(self.solutions))}
+        for fut in concurrent.futures.as_completed(futures):
+            i = futures[fut]
+            self._compilation_done(i)
             
-            if self.compilation_jobs[i].is_ok():
-                self.compilation_jobs[i].fetch(self.relative("compilations", "{}".format(i)))
-            self.compilation_jobs[i].release()
-
-        for j in range(len(self.test_indices)):
-            for i in range(len(self.solutions)):
-                is_ce = not self.compilation_jobs[i].is_ok()
+            is_ce = not self.compilation_jobs[i].is_ok()
+            for j in range(len(self.test_indices)):
                 self.descriptors[i][j].start(is_ce = is_ce)
+
+    def _compilation_done(self, i):
+        if self.reused[i]:
+            return
+
+        job = self.compilation_jobs[i]
+        if job.is_ok_or_re():
+            job.fetch_stdout(self.relative("compilations", "{}_out".format(i)))
+            job.fetch_stderr(self.relative("compilations", "{}_err".format(i)))
+            with open(self.relative("compilations", "{}_code".format(i)), "w") as fp:
+                fp.write(str(job.exit_code()))
+            
+        if job.is_ok():
+            job.fetch(self.relative("compilations", "{}".format(i)), runnable=True)
+            # so the next invocations (and "pmaker run") don't compile it again
+            self.prob.store_compilation(self.relative("compilations", "{}".format(i)), "solutions", self.solutions[i], headers=job.get_dependencies())
+        job.release()
                     
+    def get_session(self, sol_no):
+        """
+        Returns the session to run solution in, or checker session if sol_no is None
+        """
+        if sol_no == None:
+            return self.check_session
+        return self.sessions[sol_no]
+
+    def _cell_done(self, desc):
+        sol_no = desc.sol_no
+        with self.cells_lock:
+            self.cells_left[sol_no] -= 1
+            sol_done = (self.cells_left[sol_no] == 0)
+            all_done = (sum(self.cells_left) == 0)
+
+        if sol_done:
+            self.sessions[sol_no].close()
+        if all_done:
+            self.check_session.close()
+
+        if not sol_done:
+            self._apply_policy(desc)
+
+    def _apply_policy(self, desc):
+        if self.policy.is_trivial() or desc.result in [InvokationStatus.SKIPPED, InvokationStatus.CE]:
+            return
+        if desc.get_status() == InvokationStatus.OK:
+            return
+
+        with self.cells_lock:
+            self.failures[desc.sol_no] += 1
+            failures = self.failures[desc.sol_no]
+
+        victims = []
+        if self.policy.max_failures and failures >= self.policy.max_failures:
+            victims = self.descriptors[desc.sol_no]
+        elif self.policy.stop_group_on_fail and desc.the_test.has_group():
+            group = desc.the_test.get_group()
+            victims = [elem for elem in self.descriptors[desc.sol_no] if elem.the_test.has_group() and elem.the_test.get_group() == group]
+
+        for elem in victims:
+            elem.skip()
+
+    def __close_sessions(self):
+        for session in self.sessions:
+            session.close()
+        self.check_session.close()
+        
     def get_solutions(self):
         return self.solutions
 
@@ -295,6 +467,8 @@ class Invokation:
         return self.test_indices
             
     def get_result(self, solution_index, test_index):
+        if self.compilation_jobs[solution_index] == None:
+            return InvokationStatus.WAITING
         if self.compilation_jobs[solution_index].is_ready():
             if self.compilation_jobs[solution_index].is_ok():
                 return self.descriptors[solution_index][test_index].get_status()
@@ -32,6 +32,9 @@ class ArchivedInvokationDesc:
     def get_rusage(self):
         return (self.tusage, self.musage)
 
+    def get_telemetry(self):
+        return self.info.get("telemetry")
+
 class ArchivedInvokation:
     def relative(self, *args):
         return os.path.join(self.workdir, *args)
@@ -108,16 +111,17 @@ class InvokationManager:
     def list_active(self):
         return self.active.keys()
     
-    def new_invocation(self, judge, solutions, test_indices):
+    def new_invocation(self, judge, solutions, test_indices, policy=None):
         timelim = self.prob.get_problem_limits().get_timelimit()
         memlim  = self.prob.get_problem_limits().get_memorylimit()
+        outlim  = self.prob.get_problem_limits().get_outputlimit()
         lst = self.list_invocations()
         
         uid  = 0 if len(lst) == 0 else max(lst) + 1
         path = os.path.join(self.homedir, str(uid))
         
         os.makedirs(path)
-        self.active[uid] = Invokation(judge, self.prob, solutions, test_indices, uid, path, timelim, memlim)
+        self.active[uid] = Invokation(judge, self.prob, solutions, test_indices, uid, path, timelim, memlim, policy=policy, OL=outlim)
 
         return (uid, self.active[uid])
 
@@ -1,18 +1,93 @@
 import shutil, stat, os
+import subprocess
+import tempfile
+import threading
+import concurrent.futures
+import functools
 
 from pmaker.judge import JobResult 
 
+def user_cache_dir(*parts):
+    """
+    Returns the directory for caches shared by all the problems of the user:
+    $PMAKER_CACHE_DIR, or $XDG_CACHE_HOME/pmaker, or ~/.cache/pmaker
+    """
+    root = os.environ.get("PMAKER_CACHE_DIR")
+    if not root:
+        root = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "pmaker")
+    return os.path.join(root, *parts)
+
+def fetch_file(src, dest, link=True):
+    """
+    Makes dest a copy of src without reading it into memory.
+
+    The file is hardlinked if possible (and link is set), otherwise copied in kernel
+    with copy_file_range, and only then with shutil.copyfile.
+    dest is replaced atomically.
+
+    Don't link the files, which may be edited in place (e.g. the files of the user).
+    """
+    try:
+        if os.path.samefile(src, dest):
+            return # renaming a link over another link to the same file does nothing, tmp would be left
+    except OSError:
+        pass
+
+    tmp = "{}.fetch-{}-{}".format(dest, os.getpid(), threading.get_ident())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+
+    try:
+        if not link:
+            raise OSError("not linking")
+        os.link(src, tmp)
+    except OSError:
+        try:
+            _copy_file_range(src, tmp)
+        except (AttributeError, OSError):
+            shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+def fetch_file_head_tail(src, dest, head, tail):
+    """
+    Makes dest a copy of src, or if src is longer than head + tail bytes,
+    of it's first head and last tail bytes, with a marker in between
+    """
+    size = os.path.getsize(src)
+    if size <= head + tail:
+        fetch_file(src, dest)
+        return
+
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        fdst.write(fsrc.read(head))
+        fdst.write("\n[... {} bytes skipped ...]\n".format(size - head - tail).encode())
+        fsrc.seek(size - tail)
+        fdst.write(fsrc.read(tail))
+
+def _copy_file_range(src, dest):
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        left = os.fstat(fsrc.fileno()).st_size
+        while left > 0:
+            count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), left)
+            if count == 0:
+                break
+            left -= count
+
 class JobHelperCommon:
     def __init__(self, judge):
         self.judge  = judge
         self.limits = None
         self.env    = self.judge.new_env()
         self.priority = 50
+        self.pool     = "run"
+        self.session  = None
+        self.sandbox  = "isolate"
         self.job = None
 
         # store this even after the inner job was released
         self._result = None
         self._exit_code = None
+        self._telemetry = None
         self._userdesc = None
 
     def set_userdesc(self, val):
@@ -23,6 +98,18 @@ class JobHelperCommon:
 
     def set_priority(self, priority):
         self.priority = priority
+
+    def set_sandbox(self, sandbox):
+        """
+        Sets the sandbox to run the job in: "isolate" (default) or "direct" (for trusted programs only)
+        """
+        self.sandbox = sandbox
+
+    def set_session(self, session):
+        """
+        Runs the job in the session, see judge.new_session()
+        """
+        self.session = session
         
     def set_limits(self, limits):
         self.limits = limits
@@ -45,10 +132,30 @@ class JobHelperCommon:
     
     def get_memusage(self):
         return self.job.get_memusage()
+
+    def get_telemetry(self):
+        """
+        Returns resource usage reported by the sandbox, see IsolatedJob.get_telemetry()
+        """
+        if self._telemetry != None:
+            return self._telemetry
+        return self.job.get_telemetry()
     
     def wait(self):
         if self.job:
             self.job.wait()
+
+    def future(self):
+        """
+        Returns concurrent.futures.Future of the started job, see judge.submit()
+        """
+        return self.job.future()
+
+    def cancel(self):
+        """
+        Cancels the started job if it is still queued, returns True on success
+        """
+        return self.job.cancel()
     
     def is_ok(self):
         return self.result().ok()
@@ -79,11 +186,29 @@ class JobHelperCommon:
     def read_stderr(self):
         with open(self.job.get_stderr_path(), "r") as f:
             return f.read()
+
+    def fetch_stdout(self, dest, capture=None):
+        """
+        Puts the stdout of the job to dest, see fetch_file()
+
+        capture: if set, only capture bytes from both the beginning and the end are kept
+        """
+        if capture:
+            fetch_file_head_tail(self.job.get_stdout_path(), dest, capture, capture)
+        else:
+            fetch_file(self.job.get_stdout_path(), dest)
+
+    def fetch_stderr(self, dest, capture=None):
+        if capture:
+            fetch_file_head_tail(self.job.get_stderr_path(), dest, capture, capture)
+        else:
+            fetch_file(self.job.get_stderr_path(), dest)
         
     def release(self):
         if self.job:
             self._result = self.job.result()
             self._exit_code = self.job.exit_code()
+            self._telemetry = self.job.get_telemetry()
             
             self.job.release()
             self.job = None
@@ -113,9 +238,20 @@ class JobHelperDumb(JobHelperCommon):
     
     def get_memusage(self):
         return 0
+
+    def get_telemetry(self):
+        return dict()
     
     def wait(self):
         pass
+
+    def future(self):
+        fut = concurrent.futures.Future()
+        fut.set_result(None)
+        return fut
+
+    def cancel(self):
+        return False
     
     def result(self):
         return JobResult.OK
@@ -131,45 +267,263 @@ class JobHelperDumb(JobHelperCommon):
 
     def read_stderr(self):
         return ""
+
+    def fetch_stdout(self, dest, capture=None):
+        with open(dest, "w") as fp:
+            pass
+
+    def fetch_stderr(self, dest, capture=None):
+        with open(dest, "w") as fp:
+            pass
         
 class JobHelperCompilation(JobHelperCommon):
+    COMPILER = "/usr/bin/g++"
+    FLAGS    = ["-std=c++14", "-O2"] # the ones affecting the code, see pmaker.pch
+
     def __init__(self, judge):
         super().__init__(judge)
+        self.pool = "compile"
+
+        # see pmaker.compile_cache
+        self._cache = None
+        self._key   = None
+        self._hit   = False
+        self._cached = None # the cache entry opened on a hit
+        self._outputs = dict() # stored outputs of the compiler replayed on a hit, name -> bytes
+        self._future = None # resolved when the completion handler returns, on a hit
+        self._source = None
+
+    def _compiler(self):
+        return JobHelperCompilation.COMPILER
+
+    def _flags(self):
+        return JobHelperCompilation.FLAGS
+
+    def _command(self, env, source):
+        """
+        Puts the source to env, returns the command producing /box/source
+        """
+        import pmaker.pch
 
-    def run(self, source, lang=None, c_handler=None, c_args=None):
-        env = self.env
         env.add_file(source, "/source.cpp")
 
-        self.job = self.judge.new_job(env, self.limits, "/usr/bin/g++", "-Wall", "-Wextra", "-std=c++14", "-O2", "/box/source.cpp", "-o", "/box/source", c_handler=c_handler, c_args=c_args, priority=self.priority, userdesc=self._userdesc)
+        # -MD: the headers used, see get_dependencies()
+        args = ["-Wall", "-Wextra", "-MD", "-fpch-deps"] + self._flags()
+        pch = pmaker.pch.get_pch_dir(self.judge, self._compiler(), self._flags())
+        if pch:
+            env.add_directory(pch, "/pch")
+            args.append("-I/pch")
+        return [self._compiler()] + args + ["/box/source.cpp", "-o", "/box/source"]
+        
+    def run(self, source, lang=None, c_handler=None, c_args=None):
+        import pmaker.compile_cache
+
+        self._source = source
+        self._cache = pmaker.compile_cache.get_compile_cache()
+        if self._cache:
+            try:
+                self._key = pmaker.compile_cache.compile_key(source, self._compiler(), self._flags())
+            except (OSError, subprocess.CalledProcessError):
+                self._cache = None
+
+        if self._cache:
+            self._cached = self._cache.open(self._key)
+            for name in pmaker.compile_cache.DirectoryCacheBackend.OUTPUTS:
+                if self._cached:
+                    self._outputs[name] = self._cache.read_output(self._key, name)
+                    if self._outputs[name] == None:
+                        # stored by an older pmaker, or evicted meanwhile
+                        self._cached.close()
+                        self._cached = None
+            self._hit = self._cached != None
+
+        if self._hit:
+            # no need to run the compiler, pretend the job completed
+            self._result = JobResult.OK
+            self._exit_code = 0
+            self._telemetry = dict()
+            self._future = concurrent.futures.Future()
+            self._future.set_running_or_notify_cancel()
+            self.judge.call_handler(functools.partial(self._complete_hit, c_handler, c_args))
+            return
+        
+        command = self._command(self.env, source)
+        self.job = self.judge.new_job(self.env, self.limits, *command, c_handler=c_handler, c_args=c_args, priority=self.priority, userdesc=self._userdesc, pool=self.pool, session=self.session, sandbox=self.sandbox)
+
+    def _complete_hit(self, c_handler, c_args):
+        try:
+            if c_handler:
+                c_handler(*(c_args or []))
+        except Exception as ex:
+            self._future.set_exception(ex)
+            raise
+        self._future.set_result(None)
+
+    def get_dependencies(self):
+        """
+        Returns the host paths of the headers used by the successful compilation, must be called before release()
+
+        These are the headers found by compile_cache.source_files() plus the ones from the -MD depfile
+        (-fpch-deps lists the headers of the precompiled headers too, see pmaker.pch) outside
+        compile_cache.system_include_dirs(), so a cache hit (which has no depfile) records the same ones.
+        The headers under system_include_dirs() are covered by compile_cache.toolchain_digest().
+        """
+        import pmaker.compile_cache
+
+        try:
+            res = pmaker.compile_cache.source_files(self._source)[1:]
+        except OSError:
+            res = []
+        if self._hit:
+            return res
+
+        try:
+            with open(self.job.get_object_path("source.d"), "r") as fp:
+                data = fp.read()
+        except OSError:
+            return res
+
+        try:
+            system = [os.path.join(elem, "") for elem in pmaker.compile_cache.system_include_dirs(self._compiler())]
+        except (OSError, subprocess.CalledProcessError):
+            system = []
+        box = os.path.join(self.job.get_object_path(), "")
+        for path in data.replace("\\\n", " ").split(":", maxsplit=1)[-1].split():
+            if path.startswith("/box/") or path.startswith("/pch/") or path.startswith(box) or not os.path.isfile(path):
+                continue
+            path = os.path.realpath(path)
+            if not path in res and not any(path.startswith(elem) for elem in system):
+                res.append(path)
+        return res
+
+    def is_ready(self):
+        return self._hit or super().is_ready()
+
+    def get_timeusage(self):
+        return 0 if self._hit else super().get_timeusage()
+
+    def get_wallusage(self):
+        return 0 if self._hit else super().get_wallusage()
+
+    def get_memusage(self):
+        return 0 if self._hit else super().get_memusage()
+
+    def exit_code(self):
+        if self._hit:
+            return 0
+        return super().exit_code()
+
+    def failure_reason(self):
+        return "" if self._hit else super().failure_reason()
+
+    def get_failure_reason(self):
+        return "" if self._hit else super().get_failure_reason()
+
+    def future(self):
+        if self._hit:
+            return self._future
+        return super().future()
+
+    def cancel(self):
+        return False if self._hit else super().cancel()
+
+    def _replay(self, name, dest, capture):
+        tmp = "{}.fetch-{}-{}".format(dest, os.getpid(), threading.get_ident())
+        with open(tmp, "wb") as fp:
+            fp.write(self._outputs[name])
+        if capture:
+            fetch_file_head_tail(tmp, dest, capture, capture)
+            os.remove(tmp)
+        else:
+            os.replace(tmp, dest)
+
+    def read_stdout(self):
+        return self._outputs["stdout"].decode(errors="replace") if self._hit else super().read_stdout()
+
+    def read_stderr(self):
+        return self._outputs["stderr"].decode(errors="replace") if self._hit else super().read_stderr()
+
+    def fetch_stdout(self, dest, capture=None):
+        if self._hit:
+            self._replay("stdout", dest, capture)
+        else:
+            super().fetch_stdout(dest, capture)
+
+    def fetch_stderr(self, dest, capture=None):
+        if self._hit:
+            self._replay("stderr", dest, capture)
+        else:
+            super().fetch_stderr(dest, capture)
 
     def fetch(self, result, runnable=False):
-        shutil.copyfile(self.job.get_object_path("source"), result)
+        if self._hit:
+            tmp = "{}.fetch-{}-{}".format(result, os.getpid(), threading.get_ident())
+            self._cached.seek(0)
+            with open(tmp, "wb") as fp:
+                shutil.copyfileobj(self._cached, fp)
+            os.replace(tmp, result)
+        else:
+            # replaced, not overwritten: result may be hardlinked elsewhere (see Problem.store_compilation)
+            fetch_file(self.job.get_object_path("source"), result)
+            if self._cache:
+                self._cache.put(self._key, result, {"stdout": self.job.get_stdout_path(), "stderr": self.job.get_stderr_path()})
         if runnable:
-            os.chmod(result, stat.S_IRWXU | stat.S_IROTH | stat.S_IRGRP)
+            # readable and executable by others, so it can be staged into boxes without a copy
+            os.chmod(result, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+
+    def release(self):
+        if self._cached:
+            self._cached.close()
+            self._cached = None
+        super().release()
+
+class JobHelperPyCompilation(JobHelperCompilation):
+    """
+    Byte-compiles the python source in the sandbox (syntax errors are compilation errors)
+    into an executable zipapp: "#!<interpreter> -S" followed by zip with __main__.pyc.
+
+    The bytecode is only valid for the interpreter it was compiled with,
+    it must be available in the sandbox too.
+    """
+    INTERPRETER = "/usr/bin/python3"
+    FLAGS       = ["-S", "zipapp"]
+    
+    # run with the interpreter being compiled for: python3 -S -c BYTECOMPILE <interpreter>
+    BYTECOMPILE = """
+import sys, marshal, zipfile, importlib.util
+with open("source.py", "rb") as fp:
+    code = compile(fp.read(), "source.py", "exec")
+with open("source", "wb") as fp:
+    # -S: disable site package import, cause failure in the sandbox
+    fp.write(b"#!" + sys.argv[1].encode() + b" -S\\n")
+    with zipfile.ZipFile(fp, "w") as zf:
+        # the header is 16 bytes since python 3.7 (flags, mtime, size), 12 before (mtime, size)
+        header = importlib.util.MAGIC_NUMBER + bytes(12 if sys.version_info >= (3, 7) else 8)
+        zf.writestr("__main__.pyc", header + marshal.dumps(code))
+"""
 
-class JobHelperPyCompilation(JobHelperDumb):
     def __init__(self, judge):
         super().__init__(judge)
+        self.interpreter = JobHelperPyCompilation.INTERPRETER
 
-    def run(self, source, c_handler=None, c_args=None):
-        self.__source = source
+    def set_interpreter(self, interpreter):
+        """
+        Sets the python interpreter, e.g. /usr/bin/pypy3
+        """
+        self.interpreter = interpreter
 
-        if c_args == None:
-            c_args = []
-            
-        if c_handler:
-            c_handler(*c_args)
+    def _compiler(self):
+        return self.interpreter
 
-    def fetch(self, result, runnable=False):
-        with open(result, "w") as fp:
-            # disable site package import
-            # cause failure in the sandbox
-            fp.write("#!/usr/bin/python3 -S\n")
-            with open(self.__source) as src:
-                fp.write(src.read())
-        
-        if runnable:
-            os.chmod(result, stat.S_IRWXU | stat.S_IROTH | stat.S_IRGRP)
+    def _flags(self):
+        return JobHelperPyCompilation.FLAGS
+
+    def get_dependencies(self):
+        return []
+
+    def _command(self, env, source):
+        env.add_file(source, "/source.py")
+        return [self.interpreter, "-S", "-c", JobHelperPyCompilation.BYTECOMPILE, self.interpreter]
 
 class JobHelperInvokation(JobHelperCommon):
     def __init__(self, judge):
@@ -178,7 +532,57 @@ class JobHelperInvokation(JobHelperCommon):
     def run(self, source, in_file=None, prog_args=[], c_handler=None, c_args=None):
         env = self.env
         env.add_exe_file(source, "/prog")
-        self.job = self.judge.new_job(env, self.limits, *(["./prog"] + prog_args), in_file=in_file, c_handler=c_handler, c_args=c_args, priority=self.priority, userdesc=self._userdesc)
+        self.job = self.judge.new_job(env, self.limits, *(["./prog"] + prog_args), in_file=in_file, c_handler=c_handler, c_args=c_args, priority=self.priority, userdesc=self._userdesc, pool=self.pool, session=self.session, sandbox=self.sandbox)
+
+class JobHelperPyBatch(JobHelperCommon):
+    """
+    Runs a python generator (zipapp made by JobHelperPyCompilation) with several argument lists
+    in one sandbox, forking a child per test after the generator's imports are done, see pmaker.forkserver
+
+    The limits are for the whole batch (at least two processes are needed),
+    the per-test cpu and wall time limits (seconds) are passed to run().
+    """
+    def __init__(self, judge):
+        super().__init__(judge)
+        self._batch = None
+        self._codes = None
+
+    def run(self, source, interpreter, tests, timelimit=None, timelimit_wall=None, c_handler=None, c_args=None):
+        import json
+        import pmaker.forkserver
+
+        (fd, self._batch) = tempfile.mkstemp(prefix="pmaker-batch-", suffix=".json")
+        with os.fdopen(fd, "w") as fp:
+            json.dump({"tests": [{"args": list(args), "stdout": "out.{}".format(i)} for (i, args) in enumerate(tests)],
+                       "timelimit": timelimit, "timelimit_wall": timelimit_wall}, fp)
+
+        env = self.env
+        env.add_file(source, "/prog")
+        env.add_file(self._batch, "/batch.json")
+        env.add_file(pmaker.forkserver.__file__, "/forkserver.py")
+        self.job = self.judge.new_job(env, self.limits, interpreter, "-S", "forkserver.py", "prog", "batch.json", c_handler=c_handler, c_args=c_args, priority=self.priority, userdesc=self._userdesc, pool=self.pool, session=self.session, sandbox=self.sandbox)
+
+    def test_exit_code(self, i):
+        """
+        Returns the exit code of the i-th test (negative signal number if killed), or None if it wasn't run
+        """
+        import json
+        
+        if self._codes == None:
+            try:
+                with open(self.job.get_object_path("results.json")) as fp:
+                    self._codes = json.load(fp)["codes"]
+            except (OSError, ValueError, KeyError):
+                self._codes = []
+        return self._codes[i] if i < len(self._codes) else None
+
+    def fetch_test_stdout(self, i, dest):
+        fetch_file(self.job.get_object_path("out.{}".format(i)), dest)
+
+    def release(self):
+        if self._batch and os.path.exists(self._batch):
+            os.remove(self._batch)
+        super().release()
 
 #Note: unused
 class JobHelperPyInvokation(JobHelperCommon):
@@ -189,7 +593,7 @@ class JobHelperPyInvokation(JobHelperCommon):
         env = self.env
         env.add_file(source, "/prog.py")
         
-        self.job = self.judge.new_job(env, self.limits, *(["/usr/bin/python3", "./prog.py"] + prog_args), in_file=in_file, c_handler=c_handler, c_args=c_args, priority=self.priority)
+        self.job = self.judge.new_job(env, self.limits, *(["/usr/bin/python3", "./prog.py"] + prog_args), in_file=in_file, c_handler=c_handler, c_args=c_args, priority=self.priority, pool=self.pool, session=self.session, sandbox=self.sandbox)
 
 #Note: unused
 class JobHelperBashInvokation(JobHelperCommon):
@@ -200,5 +604,5 @@ class JobHelperBashInvokation(JobHelperCommon):
         env = self.env
         env.add_file(source, "/prog.sh")
         
-        self.job = self.judge.new_job(env, self.limits, *(["/bin/bash", "./prog.sh"] + prog_args), in_file=in_file, c_handler=c_handler, c_args=c_args, priority=self.priority)
+        self.job = self.judge.new_job(env, self.limits, *(["/bin/bash", "./prog.sh"] + prog_args), in_file=in_file, c_handler=c_handler, c_args=c_args, priority=self.priority, pool=self.pool, session=self.session, sandbox=self.sandbox)
 
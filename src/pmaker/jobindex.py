@@ -0,0 +1,107 @@
+import os, os.path
+import json
+import shutil
+import sqlite3
+import threading
+
+class JobIndex:
+    """
+    Records of the completed JobCache jobs: job id -> [[dependency path, digest], ...],
+    in one sqlite database instead of a JSON file per job.
+
+    All the records are read with one query when the index is opened, the records
+    written by other pmaker processes later are looked up one by one.
+    If the database can't be opened, records are only kept in memory.
+
+    Thread-safe.
+    """
+    def __init__(self, path, legacy_dir=None):
+        """
+        legacy_dir: directory with the JSON records of older pmaker, imported (and removed) if present
+        """
+        self._lock    = threading.Lock()
+        self._records = dict()
+
+        try:
+            self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, deps TEXT)")
+            self._db.commit()
+
+            for (job_id, deps) in self._db.execute("SELECT job_id, deps FROM jobs"):
+                self._records[job_id] = json.loads(deps)
+        except (sqlite3.Error, ValueError):
+            self._db = None
+
+        if legacy_dir and os.path.isdir(legacy_dir):
+            self._import(legacy_dir)
+
+    def _import(self, legacy_dir):
+        records = dict()
+        for job_id in os.listdir(legacy_dir):
+            try:
+                with open(os.path.join(legacy_dir, job_id), "r") as fp:
+                    deps = json.load(fp)
+            except (OSError, ValueError):
+                continue
+
+            if type(deps) == list and all(type(elem) == list and len(elem) == 2 for elem in deps):
+                records[job_id] = deps
+
+        self.put_many(records)
+        if self._db != None:
+            shutil.rmtree(legacy_dir, ignore_errors=True)
+
+    def get(self, job_id):
+        """
+        Returns the dependencies recorded for the job, or None
+        """
+        with self._lock:
+            if job_id in self._records:
+                return self._records[job_id]
+            if self._db == None:
+                return None
+
+            try:
+                row = self._db.execute("SELECT deps FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+                if row == None:
+                    return None
+                self._records[job_id] = json.loads(row[0])
+            except (sqlite3.Error, ValueError):
+                return None
+            return self._records[job_id]
+
+    def find(self, prefix):
+        """
+        Returns dict job id -> dependencies of the jobs with ids starting with prefix
+        """
+        with self._lock:
+            if self._db != None:
+                try:
+                    for (job_id, deps) in self._db.execute("SELECT job_id, deps FROM jobs WHERE substr(job_id, 1, ?) = ?", (len(prefix), prefix)):
+                        if not job_id in self._records:
+                            self._records[job_id] = json.loads(deps)
+                except (sqlite3.Error, ValueError):
+                    pass
+            return {job_id: deps for (job_id, deps) in self._records.items() if job_id.startswith(prefix)}
+
+    def put(self, job_id, deps):
+        self.put_many({job_id: deps})
+
+    def put_many(self, records):
+        """
+        records: dict job id -> dependencies, written in one transaction
+        """
+        records = {job_id: [list(elem) for elem in deps] for (job_id, deps) in records.items()}
+        with self._lock:
+            self._records.update(records)
+            if self._db == None:
+                return
+
+            try:
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?)",
+                                         [(job_id, json.dumps(deps)) for (job_id, deps) in records.items()])
+            except sqlite3.Error:
+                pass
@@ -5,6 +5,11 @@ import shutil
 import queue
 import traceback
 import os, os.path
+import stat
+import collections
+import signal
+import time
+import concurrent.futures
 
 class IsolatedJobEnvironment:
     def __init__(self):
@@ -30,6 +35,194 @@ class IsolatedJobEnvironment:
     def _get_instructions(self):
         return self._instructions
 
+class StagingArea:
+    """
+    Exposes host files inside the box without duplicating their data.
+
+    Files are hardlinked into a per-box staging directory, which is bind
+    mounted read-only into the sandbox, the box itself only gets symlinks.
+    If hardlinking is not possible (no staging directory, other filesystem,
+    file not readable by the sandbox user) the file is reflinked into the box,
+    and only if that fails too, it is copied.
+    """
+    MOUNT = "/_stage"
+    FICLONE = 0x40049409
+
+    def __init__(self, root, box_id):
+        self._dir     = os.path.join(root, str(box_id)) if root else None
+        self._count   = 0
+        self._mounted = False
+        self._links   = dict() # target -> name of the link in staging directory
+
+        self.clear()
+        if self._dir:
+            try:
+                os.makedirs(self._dir, exist_ok=True)
+                os.chmod(self._dir, 0o755)
+            except OSError:
+                self._dir = None
+
+    def _try_link(self, host, executable):
+        if not self._dir:
+            return None
+
+        mode = os.stat(host).st_mode
+        need = stat.S_IROTH | (stat.S_IXOTH if executable else 0)
+        if mode & need != need:
+            return None
+
+        self._count += 1
+        name = "{}_{}".format(self._count, os.path.basename(host))
+        try:
+            os.link(host, os.path.join(self._dir, name))
+        except OSError:
+            return None
+
+        self._mounted = True
+        return "{}/{}".format(StagingArea.MOUNT, name)
+
+    def _try_reflink(self, host, target):
+        import fcntl
+        try:
+            with open(host, "rb") as src, open(target, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), StagingArea.FICLONE, src.fileno())
+            return True
+        except (OSError, ValueError):
+            return False
+        
+    def stage(self, host, target, executable=False):
+        """
+        Makes the host file available as target (path on the host, inside the box)
+        """
+        if os.path.lexists(target):
+            os.remove(target)
+        self.forget(target)
+        
+        linked = self._try_link(host, executable)
+        if linked:
+            os.symlink(linked, target)
+            self._links[target] = os.path.basename(linked)
+            return
+
+        if not self._try_reflink(host, target):
+            shutil.copyfile(host, target)
+        if executable:
+            os.chmod(target, 0o755)
+
+    def get_isolate_args(self):
+        if self._mounted:
+            return ["--dir={}={}".format(StagingArea.MOUNT, self._dir)]
+        return []
+
+    def is_intact(self, host, target):
+        """
+        Returns True if the target is still the link to the staged host file.
+
+        Targets staged by copying can't be checked, False is returned for them.
+        """
+        if not target in self._links or not os.path.islink(target):
+            return False
+
+        name = self._links[target]
+        try:
+            return os.readlink(target) == "{}/{}".format(StagingArea.MOUNT, name) and os.path.samefile(os.path.join(self._dir, name), host)
+        except OSError:
+            return False
+
+    def forget(self, target):
+        """
+        Drops the staged data for the target, the target itself is not touched
+        """
+        if target in self._links:
+            os.remove(os.path.join(self._dir, self._links[target]))
+            del self._links[target]
+
+    def retain(self, targets):
+        """
+        Drops the staged data for everything except targets
+        """
+        for target in list(self._links.keys()):
+            if not target in targets:
+                self.forget(target)
+
+    def clear(self):
+        if self._dir and os.path.isdir(self._dir):
+            for name in os.listdir(self._dir):
+                os.remove(os.path.join(self._dir, name))
+        self._mounted = False
+        self._links   = dict()
+
+class SessionBox:
+    """
+    Initialized box, leased to a session.
+
+    Executables staged into it are kept between jobs (and checked before each job,
+    as the job may replace them), everything else, /tmp of the box included,
+    is removed by reset().
+    """
+    def __init__(self, box_id, workdir, staging):
+        self.box_id      = box_id
+        self.workdir     = workdir
+        self.staging     = staging
+        self.executables = dict() # virtual -> host
+
+    def is_staged(self, host, virtual):
+        return self.executables.get(virtual) == host and self.staging.is_intact(host, os.path.join(self.workdir, virtual[1:]))
+
+    def _clear_dir(self, path, keep=()):
+        for name in os.listdir(path):
+            if name in keep:
+                continue
+
+            elem = os.path.join(path, name)
+            if os.path.isdir(elem) and not os.path.islink(elem):
+                shutil.rmtree(elem)
+            else:
+                os.remove(elem)
+
+    def reset(self):
+        """
+        Returns False if the box can't be cleaned (e.g. files left in /tmp by the sandbox user),
+        such box must be initialized again
+        """
+        keep = set(virtual[1:] for virtual in self.executables.keys())
+        self._clear_dir(self.workdir, keep)
+        self.staging.retain(set(os.path.join(self.workdir, name) for name in keep))
+
+        tmp = os.path.join(os.path.dirname(self.workdir), "tmp")
+        if os.path.isdir(tmp):
+            try:
+                self._clear_dir(tmp)
+            except PermissionError:
+                return False
+        return True
+
+class IsolatedSession:
+    """
+    Series of jobs running the same executables, e.g. one solution on all the tests.
+
+    Jobs of the session reuse boxes of the previous jobs: the executables are
+    staged only once and only the job files are removed between the runs.
+    Executables are considered the same if their host paths match, so
+    they must not change while the session is open.
+
+    Idle boxes of the session are given back to the judge on close(),
+    or when the judge runs out of boxes.
+    """
+    def __init__(self, judge):
+        self._judge  = judge
+        self._idle   = []
+        self._closed = False
+
+    def close(self):
+        self._judge._close_session(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
 class JobResult(enum.Enum):
     OK = 0
     TL = 1
@@ -37,6 +230,7 @@ class JobResult(enum.Enum):
     SG = 3
     ML = 4
     FL = 5
+    OL = 6
 
     """
     FL is for system failure
@@ -58,6 +252,7 @@ class SimpleJobLimits:
         self.timelimit      = None
         self.timelimit_wall = None
         self.memorylimit    = None
+        self.outputlimit    = None
         self.proclimit      = 1
         
     def set_timelimit(self, tm):
@@ -97,6 +292,15 @@ class SimpleJobLimits:
 
         self.memorylimit = mem
 
+    def set_outputlimit(self, size):
+        """
+        Sets the max size of any file written by the job, stdout included
+
+        Parameters:
+        size: limit in kb's, as integer.
+        """
+        self.outputlimit = size
+
     def get_timelimit(self):
         return self.timelimit
     
@@ -108,11 +312,16 @@ class SimpleJobLimits:
     
     def get_memorylimit(self):
         return self.memorylimit
+
+    def get_outputlimit(self):
+        return self.outputlimit
     
 class IsolatedJob:
-    def __init__(self, judge, env, limits, *command, in_file=None, c_handler=None, c_args=None):
+    def __init__(self, judge, env, limits, *command, in_file=None, c_handler=None, c_args=None, session=None):
         from time import time
         self.__time = time()
+        self._timings = dict()
+        self._mark("created")
         
 
         self._judge     = judge
@@ -122,6 +331,8 @@ class IsolatedJob:
         self._in_file   = in_file
         self._c_handler = c_handler
         self._c_args    = c_args
+        self._session   = session
+        self._sbox      = None
         
         self._step = "pending"
         
@@ -133,79 +344,122 @@ class IsolatedJob:
         
         self._lock     = threading.Lock()
         self._cv       = threading.Condition(lock=self._lock)
+        self._future   = concurrent.futures.Future()
+        self._future.add_done_callback(self._on_future_done)
 
         self._workdir  = None
+        self._staging  = None
         self._quite    = False
         
-        self._exitcode = None
-        self._exitsig  = None
+        self._exitcode  = None
+        self._exitsig   = None
+        self._telemetry = dict()
 
         self._userdesc = None
 
     def set_quite(self):
-        self.quite = True
+        self._quite = True
 
     def set_userdesc(self, desc):
         self._userdesc = desc
         
-    def _init(self, box_id):
-        subprocess.check_call(["isolate", "--cleanup", "--cg", "--box-id={}".format(box_id)], timeout=10)
-        self._workdir = subprocess.check_output(["isolate", "--init", "--cg", "--box-id={}".format(box_id)], timeout=10, universal_newlines=True).strip() + "/box"
-        
-    def _parse_result(self, isolate_meta):
-        def parse_time(value):
-            # Probably OK, but TODO
-            return int(1000 * float(value))
-        
-        the_result = None
+    # isolate meta fields: key -> (telemetry key, parser)
+    META_FIELDS = {
+        "time":          ("time",          lambda value: int(1000 * float(value))), # ms
+        "time-wall":     ("time_wall",     lambda value: int(1000 * float(value))), # ms
+        "cg-mem":        ("cg_mem",        int), # kb
+        "max-rss":       ("max_rss",       int), # kb
+        "csw-voluntary": ("csw_voluntary", int),
+        "csw-forced":    ("csw_forced",    int),
+        "exitcode":      ("exitcode",      int),
+        "exitsig":       ("exitsig",       int),
+        "killed":        ("killed",        lambda value: value == "1"),
+        "cg-oom-killed": ("oom_killed",    lambda value: value == "1"),
+        "cg-enabled":    ("cg_enabled",    lambda value: value == "1"),
+        "message":       ("message",       str),
+        "status":        ("status",        str),
+    }
+
+    def _parse_meta(self, isolate_meta):
+        """
+        Parses all the isolate meta fields into telemetry, unknown fields are kept as strings
+        """
+        telemetry = dict()
         for line in isolate_meta.split("\n"):
             if len(line) == 0:
                 continue
-            
+
             (key, value) = line.split(":", maxsplit=1)
-            if key == "status":
-                the_result = {"OK": JobResult.OK, "TO": JobResult.TL, "RE": JobResult.RE,
-                              "SG": JobResult.RE, "XX": JobResult.FL}[value]
-            if key == "time":
-                self._timeusage = parse_time(value)
-            if key == "time-wall":
-                self._wallusage = parse_time(value)
-            if key == "cg-mem":
-                self._memusage  = int(value)
-            if key == "exitcode":
-                self._exitcode  = int(value)
-                if self._exitcode == 0:
-                    the_result = JobResult.OK
-            if key == "exitsig":
-                self._exitsig   = value
-                the_result = JobResult.SG
+            (name, conv) = IsolatedJob.META_FIELDS.get(key, (key.replace("-", "_"), str))
+            try:
+                telemetry[name] = conv(value)
+            except ValueError:
+                telemetry[name] = value
+        return telemetry
+
+    def _parse_result(self, isolate_meta):
+        telemetry = self._parse_meta(isolate_meta)
+        self._telemetry = telemetry
+
+        the_result = None
+        if "status" in telemetry:
+            the_result = {"OK": JobResult.OK, "TO": JobResult.TL, "RE": JobResult.RE,
+                          "SG": JobResult.RE, "XX": JobResult.FL}[telemetry["status"]]
+        if "time" in telemetry:
+            self._timeusage = telemetry["time"]
+        if "time_wall" in telemetry:
+            self._wallusage = telemetry["time_wall"]
+        if "cg_mem" in telemetry:
+            self._memusage  = telemetry["cg_mem"]
+        if "exitcode" in telemetry:
+            self._exitcode  = telemetry["exitcode"]
+            if self._exitcode == 0:
+                the_result = JobResult.OK
+        if "exitsig" in telemetry:
+            self._exitsig   = str(telemetry["exitsig"])
+            the_result = JobResult.SG
+        if telemetry.get("oom_killed") and the_result != JobResult.OK:
+            the_result = JobResult.ML
 
         if the_result == None:
             raise ValueError("Result not provided, responce was:\n" + isolate_meta)
         return the_result
                 
-    def _run(self, box_id):
+    def _prepare_run(self, box_id):
+        """
+        Stages the files into the box and returns the isolate command line
+        """
         isolate_head = ["isolate", "--run", "--meta=/dev/stdout", "-s", "--cg", "--cg-timing", "--box-id={}".format(box_id)]
         isolate_mid  = []
         isolate_tail = ["--"] + self._command
 
         isolate_head.append("--dir=/etc") # for g++ compilers through /etc/alternatives
         
+        if self._sbox:
+            self._staging = self._sbox.staging
+        else:
+            self._staging = StagingArea(self._judge._stage_root, box_id)
+
         if self._env:
             for (tp, host, virtual) in self._env._get_instructions():
                 if tp == 0: # dir
-                    isolate_mid.append("--dir={}={}".format(host, virtual))
+                    isolate_mid.append("--dir={}={}".format(virtual, host))
                 elif tp == 1:
-                    shutil.copyfile(host, os.path.join(self._workdir, virtual[1:]))
+                    self._staging.stage(host, os.path.join(self._workdir, virtual[1:]))
                 elif tp == 2:
-                    shutil.copyfile(host, os.path.join(self._workdir, virtual[1:]))
-                    os.chmod(os.path.join(self._workdir, virtual[1:]), 0o755)
+                    if self._sbox and self._sbox.is_staged(host, virtual):
+                        continue
+                    self._staging.stage(host, os.path.join(self._workdir, virtual[1:]), executable=True)
+                    if self._sbox:
+                        self._sbox.executables[virtual] = host
 
         if self._limits:
             if self._limits.memorylimit:
                 isolate_head.append("--cg-mem={}".format(self._limits.memorylimit))
             if self._limits.proclimit:
                 isolate_head.append("--processes={}".format(self._limits.proclimit))
+            if self._limits.outputlimit:
+                isolate_head.append("--fsize={}".format(self._limits.outputlimit))
                 
             TL  = self._limits.timelimit
             WTL = self._limits.timelimit_wall
@@ -224,7 +478,8 @@ class IsolatedJob:
                 pass
         
         if self._in_file:
-            shutil.copyfile(self._in_file, os.path.join(self._workdir, "_files", "stdin"))
+            self._staging.stage(self._in_file, os.path.join(self._workdir, "_files", "stdin"))
+        isolate_mid += self._staging.get_isolate_args()
 
         isolate_head.append( "--stdin={}".format("_files/stdin"))
         isolate_head.append("--stdout={}".format("_files/stdout"))
@@ -237,51 +492,141 @@ class IsolatedJob:
                 print("isolate-run box={} [{}]".format(box_id, self._userdesc))
             else:
                 print("isolate-run box={}".format(box_id))
-        
-        res = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-        
-        if res.returncode not in [0, 1]:
+        return cmd
+
+    def _finish_run(self, returncode, isolate_meta):
+        if returncode not in [0, 1]:
             raise Exception("Isolate returned bad exit code")
 
-        self._result = self._parse_result(res.stdout)
+        self._result = self._parse_result(isolate_meta)
         if self._result == JobResult.FL:
             self._failure_reason = "Returned by checker"
-        
+        if self._output_exceeded():
+            self._result = JobResult.OL
+        self._notify()
+
+    def _output_exceeded(self):
+        """
+        Job is killed by SIGXFSZ on the output limit, or gets EFBIG and (likely) crashes
+        """
+        if not self._limits or not self._limits.outputlimit or not self._result in [JobResult.SG, JobResult.RE]:
+            return False
+        if self._exitsig != None and int(self._exitsig) == signal.SIGXFSZ:
+            return True
+        try:
+            return os.path.getsize(os.path.join(self._workdir, "_files", "stdout")) >= 1024 * self._limits.outputlimit
+        except OSError:
+            return False
+
+    def _run(self, box_id):
+        cmd = self._prepare_run(box_id)
+        res = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        self._finish_run(res.returncode, res.stdout)
+
+    def _notify(self):
+        self._mark("executed")
         with self._lock:
             self._cv.notify_all()
 
-    def _clean(self, box_id):
-        if self._workdir:
-            try:
-                subprocess.call(["isolate", "--cleanup", "--cg", "--box-id={}".format(box_id)], timeout=1)
-            except Exception as ex:
-                print("warning: failed to cleanup: {}".format(ex))
-
     def _just_fail(self):
         self._failure_reason = "Aborted"
         self._result = JobResult.FL
-        with self._lock:
-            self._cv.notify_all()
+        self._notify()
+        if self._future.set_running_or_notify_cancel():
+            self._future.set_result(self)
+
+    def _start_running(self):
+        """
+        Called by the worker when the job is dequeued, returns False if the job was cancelled
+        """
+        return self._future.set_running_or_notify_cancel()
+
+    def _on_future_done(self, fut):
+        if fut.cancelled():
+            self._failure_reason = "Cancelled"
+            self._result = JobResult.FL
+            self._notify()
+
+    def cancel(self):
+        """
+        Cancels the job if it is still queued, returns True on success.
+
+        Cancelled job is never run and it's completion handler is not called,
+        it fails with "Cancelled" reason. Running or complete jobs are not affected.
+        """
+        return self._future.cancel()
+
+    def is_cancelled(self):
+        return self._future.cancelled()
+
+    def future(self):
+        """
+        Returns concurrent.futures.Future of the job, see IsolatedJudge.submit()
+        """
+        return self._future
                 
-    def _work(self, box_id):
+    def _mark(self, stage):
+        self._timings[stage] = time.monotonic()
+
+    def get_timings(self):
+        """
+        Returns durations (in seconds) of the job stages passed so far:
+
+        queue_wait: from creation until a worker took the job,
+        box_wait:   until the box was ready,
+        run:        staging and running in the sandbox,
+        handler:    the completion handler, including the wait for a free handler thread.
+        """
+        stages = [("queue_wait", "created", "dequeued"), ("box_wait", "dequeued", "started"),
+                  ("run", "started", "executed"), ("handler", "executed", "handled")]
+        res = dict()
+        for (name, start, end) in stages:
+            if start in self._timings and end in self._timings:
+                res[name] = self._timings[end] - self._timings[start]
+        return res
+
+    def _needs_box(self):
+        return True
+        
+    def _attach(self, box_id, workdir, init_error=None, sbox=None):
         self._box_id = box_id
+        self._sbox   = sbox
 
+        self._step = "init"
+        if workdir == None:
+            raise Exception("Box {} is not initialized: {}".format(box_id, init_error))
+        self._workdir = workdir
+        self._step = "run"
+        self._mark("started")
+
+    def _fail(self, ex):
+        self._failure_reason = "During {}\n{}\n{}".format(self._step, str(ex), traceback.format_exc())
+        self._result = JobResult.FL
+        self._notify()
+        
+    def _work(self, box_id, workdir, init_error=None, sbox=None):
         try:
-            self._step = "init"
-            self._init(box_id)
-            self._step = "run"
+            self._attach(box_id, workdir, init_error, sbox)
             self._run(box_id)
         except Exception as ex:
-            self._failure_reason = "During {}\n{}\n{}".format(self._step, str(ex), traceback.format_exc())
-            self._result = JobResult.FL
-            with self._lock:
-                self._cv.notify_all()
-            
-        if self._c_handler:
-            if self._c_args:
-                self._c_handler(*self._c_args)
-            else:
-                self._c_handler()
+            self._fail(ex)
+
+        self._judge._handle_completion(self)
+
+    def _complete(self):
+        try:
+            if self._c_handler:
+                if self._c_args:
+                    self._c_handler(*self._c_args)
+                else:
+                    self._c_handler()
+        except Exception as ex:
+            self._mark("handled")
+            self._future.set_exception(ex)
+            raise
+
+        self._mark("handled")
+        self._future.set_result(self)
 
     def get_timeusage(self):
         self.wait()
@@ -294,6 +639,16 @@ class IsolatedJob:
     def get_memusage(self):
         self.wait()
         return self._memusage
+
+    def get_telemetry(self):
+        """
+        Returns dict with everything the sandbox reported about the run:
+        time, time_wall (ms), cg_mem, max_rss (kb), csw_voluntary, csw_forced,
+        exitcode, exitsig, killed, oom_killed, message, status, etc.
+        Only the fields reported are present.
+        """
+        self.wait()
+        return dict(self._telemetry)
                 
     def is_running(self):
         return self._step == "run"
@@ -347,29 +702,324 @@ class IsolatedJob:
         """
         if hasattr(self, "_box_id"):
             self.wait()
-            self._clean(self._box_id)
+            if self._sbox:
+                self._judge._returnid(self._box_id, sbox=self._sbox, session=self._session)
+                self._sbox = None
+                self._staging = None
+                delattr(self, "_box_id")
+                return
+            
+            if self._staging:
+                self._staging.clear()
+                self._staging = None
             self._judge._returnid(self._box_id)
             delattr(self, "_box_id")
 
     def __lt__(self, other):
         return self.__time < other.__time
 
-class IsolatedJudge:
-    def __init__(self):
-        self._num_threads = 4
+class BoxManager:
+    """
+    Keeps a pool of initialized isolate boxes.
+
+    Released boxes are cleaned up and initialized again on background threads,
+    so a worker normally gets a ready box without waiting for isolate.
+    """
+    def __init__(self, box_ids, num_threads=None):
+        self._box_ids = list(box_ids)
+        self._ready   = queue.Queue()
+        self._dirty   = queue.Queue()
+        self._lock    = threading.Lock()
+
+        # statistics, in seconds
+        self._num_prepared = 0
+        self._prepare_time = 0
+        self._wait_time    = 0
+
+        if num_threads == None:
+            num_threads = max(1, len(self._box_ids) // 2)
         
-        self._queue = queue.PriorityQueue()
-        self._boxes = queue.Queue()
-        self._running = True
+        for box_id in self._box_ids:
+            self._dirty.put(box_id)
+
+        self._threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target = BoxManager._recycle, args = (self,))
+            thread.start()
+            self._threads.append(thread)
+
+    def _cleanup(self, box_id, timeout=10):
+        subprocess.check_call(["isolate", "--cleanup", "--cg", "--box-id={}".format(box_id)], timeout=timeout)
+        
+    def _prepare(self, box_id):
+        self._cleanup(box_id)
+        return subprocess.check_output(["isolate", "--init", "--cg", "--box-id={}".format(box_id)], timeout=10, universal_newlines=True).strip() + "/box"
+
+    def _recycle(self):
+        from time import time
+        
+        while True:
+            box_id = self._dirty.get()
+            if box_id == None:
+                return
+
+            start = time()
+            workdir, error = None, None
+            try:
+                workdir = self._prepare(box_id)
+            except Exception as ex:
+                error = str(ex)
+
+            with self._lock:
+                self._num_prepared += 1
+                self._prepare_time += time() - start
+            self._ready.put((box_id, workdir, error))
+
+    def acquire(self, timeout=None):
+        """
+        Returns (box_id, workdir, error) of the initialized box, waits if there is none.
+
+        workdir is None if the box failed to initialize, error describes the reason then.
+        Raises queue.Empty if no box was ready within timeout.
+        """
+        from time import time
+        
+        start = time()
+        try:
+            return self._ready.get(timeout=timeout)
+        finally:
+            with self._lock:
+                self._wait_time += time() - start
+
+    def release(self, box_id):
+        self._dirty.put(box_id)
+
+    def get_stats(self):
+        """
+        Returns dict with number of prepared boxes, total time of preparation
+        and total time workers waited for boxes (seconds)
+        """
+        with self._lock:
+            return {"prepared": self._num_prepared, "prepare_time": self._prepare_time, "wait_time": self._wait_time}
+
+    def report(self):
+        return "box manager: {prepared} boxes prepared in background, {prepare_time:.2f}s of isolate init/cleanup off the critical path, workers waited {wait_time:.2f}s for boxes".format(**self.get_stats())
         
-        for i in range(2 * self._num_threads):
-            self._boxes.put(300 + i)
+    def shutdown(self):
+        for thr in self._threads:
+            self._dirty.put(None)
+        for thr in self._threads:
+            thr.join()
+
+        leftover = []
+        while not self._dirty.empty():
+            leftover.append(self._dirty.get())
+        while not self._ready.empty():
+            leftover.append(self._ready.get()[0])
+
+        for box_id in leftover:
+            try:
+                self._cleanup(box_id, timeout=1)
+            except Exception as ex:
+                print("warning: failed to cleanup: {}".format(ex))
+
+class CompletionExecutor:
+    """
+    Runs completion handlers of the jobs on its own threads,
+    so the judge workers are only busy with the sandboxes.
+
+    The queue of handlers is bounded: if handlers can't keep up,
+    submit() blocks and workers stop taking new jobs until they do.
+    """
+    def __init__(self, num_threads, max_pending):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock  = threading.Lock()
+
+        # statistics, in seconds
+        self._num_handled  = 0
+        self._busy_time    = 0
+        self._blocked_time = 0
 
         self._threads = []
-        for i in range(self._num_threads):
-            thread = threading.Thread(target = IsolatedJudge._work, args = (self,))
+        for i in range(num_threads):
+            thread = threading.Thread(target=CompletionExecutor._work, args=(self,))
             thread.start()
             self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func = self._queue.get()
+            if func == None:
+                return
+
+            start = time.monotonic()
+            try:
+                func()
+            except Exception:
+                print("warning: completion handler failed:\n{}".format(traceback.format_exc()))
+
+            with self._lock:
+                self._num_handled += 1
+                self._busy_time   += time.monotonic() - start
+
+    def submit(self, func):
+        """
+        Schedules func(), blocks while too many handlers are pending. Thread-safe
+        """
+        start = time.monotonic()
+        self._queue.put(func)
+        with self._lock:
+            self._blocked_time += time.monotonic() - start
+
+    def get_stats(self):
+        """
+        Returns dict with number of handlers run, their total time and the
+        total time workers were blocked because the queue was full (seconds)
+        """
+        with self._lock:
+            return {"handled": self._num_handled, "busy_time": self._busy_time, "blocked_time": self._blocked_time}
+
+    def report(self):
+        return "completion handlers: {handled} run in {busy_time:.2f}s, workers blocked {blocked_time:.2f}s on the full queue".format(**self.get_stats())
+
+    def shutdown(self):
+        """
+        Runs the pending handlers and stops the threads
+        """
+        for thr in self._threads:
+            self._queue.put(None)
+        for thr in self._threads:
+            thr.join()
+
+def _cgroup_cpu_limit():
+    """
+    Returns the number of cpus allowed by the cgroup cpu quota (rounded up),
+    or None if there is no quota (or it can't be determined).
+
+    Both cgroup v2 (cpu.max) and v1 (cpu.cfs_quota_us) are supported,
+    the quota is checked on every level up to the root.
+    """
+    import math
+
+    try:
+        with open("/proc/self/cgroup", "r") as fp:
+            lines = fp.read().split("\n")
+    except OSError:
+        return None
+
+    best = None
+    for line in lines:
+        parts = line.split(":", maxsplit=2)
+        if len(parts) != 3:
+            continue
+
+        (_, controllers, path) = parts
+        candidates = []
+        if controllers == "":
+            # cgroup v2
+            candidates.append((os.path.join("/sys/fs/cgroup", path.lstrip("/")), "v2"))
+        elif "cpu" in controllers.split(","):
+            for mnt in ["/sys/fs/cgroup/cpu,cpuacct", "/sys/fs/cgroup/cpu"]:
+                candidates.append((os.path.join(mnt, path.lstrip("/")), "v1"))
+
+        for (cgdir, version) in candidates:
+            while cgdir.startswith("/sys/fs/cgroup"):
+                quota, period = None, None
+                try:
+                    if version == "v2":
+                        with open(os.path.join(cgdir, "cpu.max"), "r") as fp:
+                            quota, period = fp.read().split()
+                    else:
+                        with open(os.path.join(cgdir, "cpu.cfs_quota_us"), "r") as fp:
+                            quota = fp.read().strip()
+                        with open(os.path.join(cgdir, "cpu.cfs_period_us"), "r") as fp:
+                            period = fp.read().strip()
+                except (OSError, ValueError):
+                    pass
+
+                if quota not in [None, "max", "-1"]:
+                    try:
+                        cpus = max(1, math.ceil(int(quota) / int(period)))
+                        best = cpus if best == None else min(best, cpus)
+                    except (ValueError, ZeroDivisionError):
+                        pass
+
+                if cgdir == os.path.dirname(cgdir):
+                    break
+                cgdir = os.path.dirname(cgdir)
+    return best
+
+def detect_cpu_count():
+    """
+    Returns the number of cpus this process is actually allowed to use.
+
+    Takes into account the affinity mask and cgroup cpu quota.
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        count = os.cpu_count() or 1
+
+    quota = _cgroup_cpu_limit()
+    if quota != None:
+        count = min(count, quota)
+    return max(1, count)
+
+class IsolatedJudge:
+    POOLS = ["run", "compile"]
+    JOB_CLASS = IsolatedJob
+
+    def __init__(self, threads=None, compile_threads=None):
+        """
+        Creates the judge
+
+        Keyword Arguments:
+        threads: number of workers running solutions, checkers, generators, etc.
+                 Defaults to the number of available cpus.
+        compile_threads: number of workers running compilations.
+                 Defaults to quarter of threads (but at least one).
+
+        Each kind of jobs has its own pool of workers, so long compilations
+        can't starve short runs.
+        """
+        if threads == None:
+            threads = detect_cpu_count()
+        if compile_threads == None:
+            compile_threads = max(1, threads // 4)
+
+        if threads < 1 or compile_threads < 1:
+            raise ValueError("Judge needs at least one worker per pool")
+
+        self._pool_size = {"run": threads, "compile": compile_threads}
+        self._num_threads = sum(self._pool_size.values())
+        
+        self._stage_root = None
+        self._running = True
+
+        self._session_lock = threading.Lock()
+        self._session_idle = collections.OrderedDict() # SessionBox -> IsolatedSession, oldest first
+
+        # utilisation of the workers: (pool, seconds spent on jobs) per worker
+        self._stats_lock  = threading.Lock()
+        self._worker_busy = []
+        self._started     = time.monotonic()
+
+        self._start()
+
+    def _box_ids(self):
+        return range(300, 300 + 2 * self._num_threads)
+        
+    def _start(self):
+        self._queues = {pool: queue.PriorityQueue() for pool in IsolatedJudge.POOLS}
+        self._boxes = BoxManager(self._box_ids())
+        self._completions = self._new_completion_executor()
+
+        self._threads = []
+        for pool in IsolatedJudge.POOLS:
+            for i in range(self._pool_size[pool]):
+                thread = threading.Thread(target = IsolatedJudge._work, args = (self, pool, self._new_worker_stats(pool)))
+                thread.start()
+                self._threads.append(thread)
         
     def __enter__(self):
         return self
@@ -377,28 +1027,174 @@ class IsolatedJudge:
     def __exit__(self, *_):
         print("shutting down judging system")
         self._running = False
-        for i in range(self._num_threads):
-            self._queue.put((-1000, None))
+        for pool in IsolatedJudge.POOLS:
+            for i in range(self._pool_size[pool]):
+                self._queues[pool].put((-1000, None))
 
         for thr in self._threads:
             thr.join()
+        self._completions.shutdown()
 
-        while not self._queue.empty():
-            job = self._queue.get()[1]
-            if job != None:
-                job._just_fail()
+        while self._evict_session_box():
+            pass
 
-    def _work(self):
+        for pool in IsolatedJudge.POOLS:
+            while not self._queues[pool].empty():
+                job = self._queues[pool].get()[1]
+                if job != None:
+                    job._just_fail()
+
+        self._boxes.shutdown()
+        if os.environ.get("PMAKER_JUDGE_STATS", "0") == "1":
+            print(self.report())
+
+    def report(self):
+        """
+        Returns statistics of the boxes, completion handlers and workers, as text
+        (printed on exit if PMAKER_JUDGE_STATS=1)
+        """
+        return "\n".join([self._boxes.report(), self._completions.report(), self.report_utilization()])
+
+    def _new_completion_executor(self):
+        return CompletionExecutor(max(1, min(4, self._num_threads)), 2 * self._num_threads)
+
+    def _new_worker_stats(self, pool):
+        stats = [pool, 0]
+        with self._stats_lock:
+            self._worker_busy.append(stats)
+        return stats
+
+    def call_handler(self, func):
+        """
+        Runs func() on the completion handler threads, like the completion handler of a job
+        (e.g. of a job, which turned out to be unnecessary). Blocks while too many handlers are pending
+        """
+        self._completions.submit(func)
+
+    def _handle_completion(self, job):
+        # the future is resolved there too: its callbacks mustn't hold the worker either
+        self._completions.submit(job._complete)
+
+    def _work(self, pool, stats):
         while True:
-            job = self._queue.get()[1]
+            job = self._queues[pool].get()[1]
             if not self._running or job == None:
                 return
-            job._work(self._boxes.get())
+            job._mark("dequeued")
+            if not job._start_running():
+                continue
+            start = time.monotonic()
+            if job._needs_box():
+                job._work(*self._acquire_box(job._session))
+            else:
+                job._work(None, None)
+            with self._stats_lock:
+                stats[1] += time.monotonic() - start
+
+    def get_utilization(self):
+        """
+        Returns dict pool -> list of fractions of time each worker of the pool
+        spent on jobs (waiting for the box included) since the judge was started
+        """
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        res = {pool: [] for pool in IsolatedJudge.POOLS}
+        with self._stats_lock:
+            for (pool, busy) in self._worker_busy:
+                res[pool].append(busy / elapsed)
+        return res
+
+    def report_utilization(self):
+        parts = []
+        for (pool, values) in sorted(self.get_utilization().items()):
+            if values:
+                parts.append("{} {:.0f}% (min {:.0f}%, max {:.0f}%)".format(pool, 100 * sum(values) / len(values), 100 * min(values), 100 * max(values)))
+        return "worker utilisation: " + ", ".join(parts)
+
+    def _acquire_box(self, session):
+        if session:
+            with self._session_lock:
+                if session._idle:
+                    sbox = session._idle.pop()
+                    del self._session_idle[sbox]
+                    return (sbox.box_id, sbox.workdir, None, sbox)
+
+        while True:
+            try:
+                (box_id, workdir, error) = self._boxes.acquire(timeout=0.1)
+            except queue.Empty:
+                # boxes may be kept by idle sessions, take them back
+                self._evict_session_box()
+                continue
+
+            sbox = None
+            if session and workdir:
+                sbox = SessionBox(box_id, workdir, StagingArea(self._stage_root, box_id))
+            return (box_id, workdir, error, sbox)
+
+    def _evict_session_box(self):
+        with self._session_lock:
+            if not self._session_idle:
+                return False
+            (sbox, session) = self._session_idle.popitem(last=False)
+            session._idle.remove(sbox)
 
-    def _returnid(self, box_id):
-        self._boxes.put(box_id)
+        sbox.staging.clear()
+        self._boxes.release(sbox.box_id)
+        return True
+
+    def _close_session(self, session):
+        with self._session_lock:
+            session._closed = True
+            boxes = session._idle
+            session._idle = []
+            for sbox in boxes:
+                del self._session_idle[sbox]
+
+        for sbox in boxes:
+            sbox.staging.clear()
+            self._boxes.release(sbox.box_id)
+        
+    def _returnid(self, box_id, sbox=None, session=None):
+        if sbox:
+            try:
+                if not sbox.reset():
+                    sbox.staging.clear()
+                    self._boxes.release(box_id)
+                    return
+                with self._session_lock:
+                    if not session._closed:
+                        session._idle.append(sbox)
+                        self._session_idle[sbox] = session
+                        return
+            except Exception as ex:
+                print("warning: failed to reset box {}: {}".format(box_id, ex))
+            sbox.staging.clear()
+        self._boxes.release(box_id)
+
+    def set_staging_dir(self, path):
+        """
+        Sets the directory used to pass files into boxes without copying.
+
+        Should be on the same filesystem as the problem data, so files can be hardlinked.
+        """
+        self._stage_root = path
+
+    def get_pool_size(self, pool="run"):
+        return self._pool_size[pool]
+
+    def get_capacity(self):
+        """
+        Returns the number of jobs the judge runs at once, in all the pools
+        """
+        return sum(self._pool_size.values())
+
+    def new_session(self):
+        """
+        Creates new session, see IsolatedSession
+        """
+        return IsolatedSession(self)
     
-    def new_job(self, env, limits, *command, in_file=None, c_handler=None, c_args=None, priority=50, userdesc=None):
+    def new_job(self, env, limits, *command, in_file=None, c_handler=None, c_args=None, priority=50, userdesc=None, pool="run", session=None, sandbox="isolate"):
         """
         Creates new runnable Job 
         
@@ -410,17 +1206,49 @@ class IsolatedJudge:
         c_args: args to path to completion handler
 
         priority: the priority of the taks, lower is more important, should be in range [0; 99].
+        pool: the pool of workers to run the job on, either "run" or "compile".
+        session: the session to run the job in, optional, use judge.new_session().
+        sandbox: "isolate" (default) or "direct" to run trusted programs without isolate, see pmaker.direct.
 
         Other arguments:
         Specify the command to run in a standard way
         """
 
-        job = IsolatedJob(self, env, limits, *command, in_file=in_file, c_handler=c_handler, c_args=c_args)
+        if not pool in self._pool_size:
+            raise ValueError("Unknown pool {}".format(pool))
+
+        job_class = self.JOB_CLASS
+        if sandbox == "direct":
+            from pmaker.direct import DirectJob
+            job_class = DirectJob
+            session = None
+        elif sandbox != "isolate":
+            raise ValueError("Unsupported sandbox {}".format(sandbox))
+            
+        job = job_class(self, env, limits, *command, in_file=in_file, c_handler=c_handler, c_args=c_args, session=session)
         if userdesc:
             job.set_userdesc(userdesc)
         
-        self._queue.put((priority, job))
+        self._enqueue(pool, priority, job)
         return job
+
+    def submit(self, env, limits, *command, **kwargs):
+        """
+        Same as new_job(), but returns concurrent.futures.Future of the job.
+
+        The future is resolved with the job itself once it is executed and
+        its completion handler (if any) returned. It works with
+        concurrent.futures.wait() and as_completed(), cancel() succeeds
+        while the job is still queued (the job then fails with "Cancelled"
+        reason and is never run), add_done_callback() chains continuations,
+        which are called on the completion handler threads.
+
+        The job still must be released: future.result().release()
+        """
+        return self.new_job(env, limits, *command, **kwargs).future()
+
+    def _enqueue(self, pool, priority, job):
+        self._queues[pool].put((priority, job))
         
     def new_env(self):
         return IsolatedJobEnvironment()
@@ -437,10 +1265,23 @@ class IsolatedJudge:
         
         if target == "invoke.g++" or target == "invoke.py3":
             return pmaker.jobhelper.JobHelperInvokation(self)
+        if target == "invoke.pybatch":
+            return pmaker.jobhelper.JobHelperPyBatch(self)
         if target == "invoke.bash":
             return pmaker.jobhelper.JobHelperBashInvokation(self)
         
         raise ValueError("Unsupported job helper type {}".format(target))
 
-def new_judge():
-    return IsolatedJudge()
+def new_judge(threads=None, compile_threads=None, engine=None):
+    """
+    Creates the judge
+
+    engine: "threads" (default) runs each worker on its own thread,
+            "asyncio" drives all the boxes from a single event loop.
+    """
+    if engine in [None, "threads"]:
+        return IsolatedJudge(threads=threads, compile_threads=compile_threads)
+    if engine == "asyncio":
+        from pmaker.async_judge import AsyncIsolatedJudge
+        return AsyncIsolatedJudge(threads=threads, compile_threads=compile_threads)
+    raise ValueError("Unsupported judge engine {}".format(engine))
@@ -0,0 +1,149 @@
+"""
+Precompiled headers for the compilation jobs.
+
+Headers are precompiled once per compiler (version and binary), set of
+flags and contents of the headers, and kept in the user cache directory (see jobhelper.user_cache_dir).
+The directory is mounted into the compilation box as /pch and passed with
+-I/pch: for "#include <bits/stdc++.h>" g++ finds /pch/bits/stdc++.h.gch
+before the real header. If the precompiled header doesn't fit (other flags,
+it's not the first include, etc.) g++ silently uses the real header instead.
+
+Set PMAKER_PCH=0 to disable.
+"""
+
+import os, os.path
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import threading
+
+HEADERS = ["bits/stdc++.h", "testlib.h"]
+
+_lock     = threading.Lock()
+_known    = dict() # key -> directory with precompiled headers, or None
+_building = dict() # key -> lock held while the headers are built
+_ids      = dict() # (compiler, size, mtime) -> compiler_id()
+
+def compiler_id(compiler):
+    """
+    Returns the string identifying the compiler: version, size and modification time of the binary
+    """
+    st  = os.stat(os.path.realpath(compiler))
+    key = (compiler, st.st_size, st.st_mtime_ns)
+    with _lock:
+        if key in _ids:
+            return _ids[key]
+
+    version = subprocess.check_output([compiler, "--version"], universal_newlines=True).split("\n")[0]
+    with _lock:
+        _ids[key] = "{} {} {}".format(version, st.st_size, st.st_mtime_ns)
+        return _ids[key]
+
+def _headers_digest():
+    """
+    Hash of the contents of HEADERS (g++ doesn't check the precompiled header against the real one),
+    headers of the compiler are covered by compiler_id()
+    """
+    import pmaker.compile_cache
+
+    hasher = hashlib.sha256()
+    for header in HEADERS:
+        for path in pmaker.compile_cache.header_files(header):
+            with open(path, "rb") as fp:
+                hasher.update("{}\0{}\n".format(path, hashlib.sha256(fp.read()).hexdigest()).encode())
+    return hasher.hexdigest()
+
+def get_pch_dir(judge, compiler, flags):
+    """
+    Returns the host directory with precompiled headers for the compiler and flags,
+    or None if there are none. Builds them with the judge on the first use.
+    """
+    if os.environ.get("PMAKER_PCH", "1") == "0":
+        return None
+
+    try:
+        ident  = compiler_id(compiler)
+        digest = _headers_digest()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    key = hashlib.sha256("\0".join([ident] + list(flags) + HEADERS + [digest]).encode()).hexdigest()[:24]
+
+    with _lock:
+        if key in _known:
+            return _known[key]
+        building = _building.setdefault(key, threading.Lock())
+
+    # other compilations (with other keys) are not blocked by the build
+    with building:
+        with _lock:
+            if key in _known:
+                return _known[key]
+
+        from pmaker.jobhelper import user_cache_dir
+
+        path = user_cache_dir("pch", key)
+        try:
+            if not os.path.isdir(path):
+                _build(judge, compiler, flags, path)
+        finally:
+            # a failed build is not retried by this process, the next one retries it
+            with _lock:
+                _known[key] = path if os.path.isdir(path) and os.listdir(path) else None
+                del _building[key]
+        with _lock:
+            return _known[key]
+
+def _build(judge, compiler, flags, path):
+    """
+    Builds into the temporary directory and renames it to path, headers which fail to compile (RE) are skipped.
+    If nothing compiles, path is left empty, so it is not retried.
+    On a system failure of the judge (or other verdicts) nothing is left, so the build is retried later.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=".build-", dir=os.path.dirname(path))
+    done = False
+
+    limits = judge.new_limits()
+    limits.set_memorylimit(1024 * 1000)
+    limits.set_timelimit(60 * 1000)
+    limits.set_timelimit_wall(90 * 1000)
+    limits.set_proclimit(4)
+
+    try:
+        wrapper = os.path.join(tmp, ".wrapper.h")
+        for header in HEADERS:
+            # the real header is found through the system include path
+            with open(wrapper, "w") as fp:
+                fp.write("#include <{}>\n".format(header))
+
+            env = judge.new_env()
+            env.add_file(wrapper, "/wrapper.h")
+            # -MD: the headers are recorded in the .gch, so -fpch-deps lists them in the compilations' depfiles
+            job = judge.new_job(env, limits, compiler, *flags, "-MD", "-MF", "/box/wrapper.d", "-x", "c++-header", "/box/wrapper.h", "-o", "/box/wrapper.h.gch",
+                                priority=10, userdesc="precompile {}".format(header), pool="compile")
+            job.wait()
+            result = job.result()
+            if result.ok():
+                dest = os.path.join(tmp, header + ".gch")
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copyfile(job.get_object_path("wrapper.h.gch"), dest)
+            job.release()
+            if not result.ok_or_re():
+                return
+        os.remove(wrapper)
+
+        # readable by the sandbox users
+        for (root, dirs, files) in os.walk(tmp):
+            os.chmod(root, 0o755)
+            for name in files:
+                os.chmod(os.path.join(root, name), 0o644)
+
+        os.rename(tmp, path)
+        done = True
+    except OSError:
+        # e.g. concurrently built by another pmaker
+        pass
+    finally:
+        if not done:
+            shutil.rmtree(tmp, ignore_errors=True)
@@ -3,6 +3,13 @@ import configparser
 import json
 import hashlib
 import shutil
+import threading
+
+from pmaker.graph import JobGraph
+from pmaker.jobhelper import fetch_file
+from pmaker.digests import DigestDB, NO_FILE, hash_file
+from pmaker.jobindex import JobIndex
+from pmaker.snapshot import Snapshot, tree_digest
 
 class ProblemError(RuntimeError):
     pass
@@ -336,54 +343,61 @@ class JobProvider:
                     return None
 
 
+# dependency on the compiler (identity and flags) instead of a file, see JobCache.file_digest()
+TOOLCHAIN_PREFIX = "toolchain:"
+
 def get_file_digest(path):
-    m = hashlib.sha256()
-    with open(path, "rb") as fp:
-        while True:
-            data = fp.read(2048)
-            if len(data) == 0:
-                break
-            m.update(data)
-    return m.hexdigest()
+    return hash_file(path)
                 
 class JobCache:
     def __init__(self, prob):
         self.prob = prob
         self.providers = []
         self.completed_jobs = set()
-        self.digest_cache   = dict()
+        self.digests        = DigestDB(prob.relative("work", "_state.db"))
+        self.index          = JobIndex(prob.relative("work", "_state.db"), legacy_dir=prob.relative("work", "_jobs"))
+
+        # jobs may be run from several threads (see update_tests), but each job only by one at a time
+        self._lock      = threading.Lock()
+        self._job_locks = dict()
 
     def register_provider(self, provider):
         self.providers.append(provider)
 
     def file_digest(self, fl):
-        if fl in self.digest_cache:
-            return self.digest_cache[fl]
+        """
+        Thread-safe, see digests.DigestDB
+
+        fl may also be TOOLCHAIN_PREFIX + lang, see Problem.toolchain_digest()
+        """
+        return self._digests([fl])[0]
+
+    def _digests(self, lst):
+        res = self.digests.digests([elem for elem in lst if not elem.startswith(TOOLCHAIN_PREFIX)])
+        res.reverse()
+        return [self.prob.toolchain_digest(elem[len(TOOLCHAIN_PREFIX):]) if elem.startswith(TOOLCHAIN_PREFIX) else res.pop() for elem in lst]
+
+    def _job_lock(self, job_id):
+        with self._lock:
+            if not job_id in self._job_locks:
+                self._job_locks[job_id] = threading.Lock()
+            return self._job_locks[job_id]
 
-        digest = "_no_file_"
-        if os.path.exists(fl):
-            digest = get_file_digest(fl)
-        
-        self.digest_cache[fl] = digest
-        return digest
-            
     def run_job(self, job_id, check_only=False):
+        """
+        Thread-safe
+        """
+        with self._job_lock(job_id):
+            self._run_job(job_id, check_only=check_only)
+
+    def _run_job(self, job_id, check_only=False):
         if job_id in self.completed_jobs:
             return
         
-        if self.prob.exists("work", "_jobs", job_id):
-            jobinfo = None
-            with open(self.prob.relative("work", "_jobs", job_id), "r") as fp:
-                jobinfo = json.load(fp)
-
-            if type(jobinfo) == list:
-                ok = True
-                for elem in jobinfo:
-                    if type(elem) != list or len(elem) != 2 or self.file_digest(elem[0]) != elem[1]:
-                        ok = False
-                        break
-                if ok:
-                    return
+        jobinfo = self.index.get(job_id)
+        if jobinfo != None:
+            if self._digests([elem[0] for elem in jobinfo]) == [elem[1] for elem in jobinfo]:
+                return
 
         if check_only:
             raise ProblemJobOutdated()
@@ -399,14 +413,25 @@ class JobCache:
 
                 if type(lst) != list:
                     raise ProblemJobError()
-                os.makedirs(self.prob.relative("work", "_jobs"), exist_ok=True)
-                with open(self.prob.relative("work", "_jobs", job_id), "w") as fp:
-                    json.dump(list(map(lambda x: (x, self.file_digest(x)), lst)), fp)
-
-                self.completed_jobs.add(job_id)
+                self._record_job(job_id, lst)
                 return
         raise ProblemJobNotFoundError()
 
+    def _record_job(self, job_id, lst):
+        self.index.put(job_id, list(zip(lst, self._digests(lst))))
+
+        self.completed_jobs.add(job_id)
+
+    def record_job(self, job_id, func):
+        """
+        Thread-safe
+
+        Marks the job as completed by func (e.g. it's result was produced elsewhere),
+        func must return the dependencies, like CacheableJob.run()
+        """
+        with self._job_lock(job_id):
+            self._record_job(job_id, func())
+
     def safe_id_from_string(self, s):
         """
         Performs some modifications to string, such that:
@@ -494,6 +519,9 @@ class ProblemBase:
         return 1000 * int(pre) + int(post)
     
 class Problem(ProblemBase):
+    # tests per fork-server batch, batches of the same generator run in parallel
+    FORK_SERVER_BATCH = 32
+
     def __init__(self, homedir, judge=None):
         super().__init__(homedir)
 
@@ -507,9 +535,19 @@ class Problem(ProblemBase):
         self._model_solution = parser.get("main", "model_solution", fallback=None)
         self._time_limit     = self.parse_millis(parser.get("main", "time_limit"))
         self._mem_limit      = self.parse_millis(parser.get("main", "memory_limit"))
+        self._output_limit   = 1024 * int(parser.get("main", "output_limit", fallback="256")) # megabytes in config, kb's here
         self._validator      = None
         self._checker        = None
         self._script         = None
+
+        # interpreter for python solutions and generators, e.g. /usr/bin/pypy3, see JobHelperPyCompilation
+        self._python = os.environ.get("PMAKER_PYTHON", parser.get("main", "python", fallback="/usr/bin/python3"))
+
+        # run the python generators in batches through the fork-server, see pmaker.forkserver
+        self._fork_server = os.environ.get("PMAKER_FORK_SERVER", self.get_judge_option("fork_server", "no")).lower() in ["1", "yes", "true", "on"]
+
+        # sandbox for the trusted jobs (script, generators and validator), see pmaker.direct
+        self._trusted_sandbox = os.environ.get("PMAKER_TRUSTED_SANDBOX", self.get_judge_option("trusted_sandbox", "isolate"))
         
         if parser.get("main", "validator", fallback=None) != None:
             self._validator  = "source/" + parser.get("main", "validator")
@@ -542,12 +580,26 @@ class Problem(ProblemBase):
     
     def set_judge(self, judge):
         self._judge = judge
+        self._judge.set_staging_dir(self.relative("work", "_stage"))
+
+    def get_judge_option(self, key, fallback=None):
+        """
+        Returns the value of key in the [judge] section of problem.cfg, or fallback if it is not set
+        """
+        return self._parser.get("judge", key, fallback=fallback)
+
+    def get_python(self):
+        """
+        Returns the python interpreter for the solutions and generators
+        """
+        return self._python
 
     def get_generator_limits(self):
         limits = self._judge.new_limits()
         limits.set_memorylimit(256 * 1000)
         limits.set_timelimit(5 * 1000)
         limits.set_timelimit_wall(10 * 1000)
+        limits.set_outputlimit(1024 * 1024)
         limits.set_proclimit(1)
         return limits
 
@@ -564,6 +616,7 @@ class Problem(ProblemBase):
         limits.set_memorylimit(1024 * 1000)
         limits.set_timelimit(30 * 1000)
         limits.set_timelimit_wall(60 * 1000)
+        limits.set_outputlimit(1024 * 1024)
         limits.set_proclimit(1)
         return limits
 
@@ -572,6 +625,7 @@ class Problem(ProblemBase):
         limits.set_memorylimit(self._mem_limit)
         limits.set_timelimit(self._time_limit)
         limits.set_timelimit_wall(2 * self._time_limit)
+        limits.set_outputlimit(self._output_limit)
         limits.set_proclimit(1)
         return limits
     
@@ -647,6 +701,7 @@ class Problem(ProblemBase):
         limits.set_proclimit(4)
 
         jh.set_limits(limits)
+        jh.set_sandbox(self._trusted_sandbox)
         jh.run(self.relative(self._script))
         jh.wait()
 
@@ -681,6 +736,8 @@ class Problem(ProblemBase):
 
         jh.set_limits(limits)
         jh.set_userdesc("compile {}".format(src))
+        if lang == 'py3':
+            jh.set_interpreter(self._python)
         jh.run(self.relative(*src))
         jh.wait()
 
@@ -691,16 +748,17 @@ class Problem(ProblemBase):
 
         os.makedirs(self.relative("work", "compiled"), exist_ok=True)
         jh.fetch(self.compile_result(*src), runnable=True)
+        headers = jh.get_dependencies()
         jh.release()
-        return [self.relative(*src)] # TODO
+        return [self.relative(*src)] + headers + [TOOLCHAIN_PREFIX + lang]
     
     def __do_mpost(self, testname):
         res = self._job_cache.safe_id_from_string(testname)
         
         os.makedirs(self.relative("work", "_data"), exist_ok=True)
-        with open(self.relative("tests.manual", testname), "r") as fsrc:
-            with open(self.relative("work", "_data", "mtest." + res), "w") as fdst:
-                fdst.write(fsrc.read())
+        # copied: the manual test may be edited in place, it mustn't change the posted test until the rebuild
+        # replaced, not overwritten: it may be hardlinked to work/tests
+        fetch_file(self.relative("tests.manual", testname), self.relative("work", "_data", "mtest." + res), link=False)
 
         return [self.relative("tests.manual", testname)]
     
@@ -717,6 +775,7 @@ class Problem(ProblemBase):
             in_file = self.relative("work", "_data", cmd_prev)
 
         jh.set_userdesc("run {}".format(cmd))
+        jh.set_sandbox(self._trusted_sandbox)
         jh.run(self.compilation_result("source", cmd[0]), prog_args=cmd[1:], in_file=in_file)
         jh.wait()
 
@@ -726,8 +785,7 @@ class Problem(ProblemBase):
             raise ProblemError("Failed to run {}, got: {}".format(cmd, jh.result()))
 
         os.makedirs(self.relative("work", "_data"), exist_ok=True)
-        with open(self.relative("work", "_data", "mgen.{}.{}".format(self._job_cache.safe_id_from_string(cmd_prev), self._job_cache.safe_id_from_slist(cmd))), "w") as fp:
-            fp.write(jh.read_stdout())
+        jh.fetch_stdout(self.relative("work", "_data", "mgen.{}.{}".format(self._job_cache.safe_id_from_string(cmd_prev), self._job_cache.safe_id_from_slist(cmd))))
 
         jh.release()
         deps = [self.compilation_result("source", cmd[0])]
@@ -735,6 +793,51 @@ class Problem(ProblemBase):
             deps.append(in_file)
         return deps
 
+    def __do_mgen_batch(self, gen, chunk):
+        """
+        Runs the outdated tests from chunk, [(mgen job id, args)] of the python generator
+        without input, in one sandbox with the fork-server (see pmaker.forkserver).
+
+        The tests, which failed, are left outdated: they are run one by one as usual, reporting the error.
+        """
+        todo = []
+        for (job_id, args) in chunk:
+            try:
+                self._job_cache.run_job(job_id, check_only=True)
+            except ProblemJobOutdated:
+                todo.append((job_id, args))
+        if not todo:
+            return []
+
+        per_test = self.get_generator_limits()
+        limits   = self._judge.new_limits()
+        limits.set_memorylimit(per_test.get_memorylimit())
+        limits.set_timelimit(len(todo) * per_test.get_timelimit())
+        limits.set_timelimit_wall(len(todo) * per_test.get_timelimit_wall())
+        limits.set_outputlimit(per_test.get_outputlimit())
+        limits.set_proclimit(2) # the server and the test
+
+        jh = self._judge.new_job_helper("invoke.pybatch")
+        jh.set_limits(limits)
+        jh.set_userdesc("run {} x{}".format(gen, len(todo)))
+        jh.set_sandbox(self._trusted_sandbox)
+        jh.run(self.compilation_result("source", gen), self._python, [args for (_, args) in todo],
+               timelimit=(per_test.get_timelimit() + 999) // 1000, timelimit_wall=(per_test.get_timelimit_wall() + 999) // 1000)
+        jh.wait()
+
+        if jh.result().ok():
+            os.makedirs(self.relative("work", "_data"), exist_ok=True)
+            for (i, (job_id, _)) in enumerate(todo):
+                if jh.test_exit_code(i) != 0:
+                    continue
+
+                def store():
+                    jh.fetch_test_stdout(i, self.relative("work", "_data", job_id))
+                    return [self.compilation_result("source", gen)] # same as __do_mgen
+                self._job_cache.record_job(job_id, store)
+        jh.release()
+        return []
+
     def __do_validate(self, group, test_path):
         jh = self._judge.new_job_helper("invoke.g++")
         jh.set_limits(self.get_validation_limits())
@@ -747,6 +850,7 @@ class Problem(ProblemBase):
             jh.set_userdesc("val group={} test={}".format(group, self._job_cache.slist_from_id(test_path)))
         else:
             jh.set_userdesc("val test={}".format(group, self._job_cache.slist_from_id(test_path)))         
+        jh.set_sandbox(self._trusted_sandbox)
         jh.run(self.relative(self.compilation_result(self._validator)), prog_args=prog_args, in_file=in_file)
         jh.wait()
         
@@ -780,8 +884,7 @@ class Problem(ProblemBase):
             raise ProblemError("Failed to generate answer for: {}, reason: {}".format(test_path, reason))
         
         os.makedirs(self.relative("work", "_data"), exist_ok=True)
-        with open(self.relative("work", "_data", out_path), "w") as fp:
-            fp.write(jh.read_stdout())
+        jh.fetch_stdout(self.relative("work", "_data", out_path))
 
         jh.release()
         deps = [self.relative(self.compilation_result("solutions", self._model_solution)), in_file]
@@ -799,9 +902,68 @@ class Problem(ProblemBase):
 
         return self._tests
 
+    def toolchain_digest(self, lang):
+        """
+        Digest of the compiler and flags used for the language ("g++" or "py3")
+        """
+        import pmaker.compile_cache
+        from pmaker.jobhelper import JobHelperCompilation, JobHelperPyCompilation
+
+        if lang == "py3":
+            return pmaker.compile_cache.toolchain_digest(self._python, JobHelperPyCompilation.FLAGS)
+        return pmaker.compile_cache.toolchain_digest(JobHelperCompilation.COMPILER, JobHelperCompilation.FLAGS)
+
+    def _compile_deps_digest(self):
+        """
+        Digest of the files recorded as dependencies of the compilations (e.g. testlib.h),
+        which changed since they were recorded
+        """
+        recorded = dict()
+        for deps in self._job_cache.index.find("comp.").values():
+            for (path, digest) in deps:
+                if not path.startswith(TOOLCHAIN_PREFIX):
+                    recorded.setdefault(path, set()).add(digest)
+
+        paths  = sorted(recorded)
+        hasher = hashlib.sha256()
+        for (path, digest) in zip(paths, self._job_cache.digests.digests(paths)):
+            if recorded[path] != {digest}:
+                hasher.update("{}\0{}\n".format(path, digest).encode())
+        return hasher.hexdigest()
+
+    def snapshot(self):
+        """
+        Returns snapshot.Snapshot of everything the tests depend on: problem.cfg, the script, source/,
+        tests.manual/, validator, checker, the model solution, the files recorded as dependencies
+        of the compilations (e.g. testlib.h) and the compilers with their flags
+        """
+        parts = dict()
+        model = os.path.join("solutions", self._model_solution) if self._model_solution else None
+        for (name, path) in [("problem.cfg", "problem.cfg"), ("script", self._script), ("source", "source"), ("tests.manual", "tests.manual"),
+                             ("validator", self._validator), ("checker", self._checker), ("model", model)]:
+            parts[name] = tree_digest(self.relative(path), self._job_cache.digests) if path else NO_FILE
+
+        parts["compile deps"] = self._compile_deps_digest()
+        parts["toolchain"] = "\n".join(self.toolchain_digest(lang) for lang in ["g++", "py3"])
+        return Snapshot(parts)
+
     def compile(self, *args, check_only=False):
         self._job_cache.run_job("comp.{}".format(self._job_cache.safe_id_from_slist(list(args))), check_only=check_only)
 
+    def store_compilation(self, binary, *args, headers=()):
+        """
+        Puts binary, compiled elsewhere (e.g. by an invocation) from the same source, to the cache of compile(*args)
+
+        headers: see JobHelperCompilation.get_dependencies()
+        """
+        lang = "py3" if args[-1].endswith(".py") else "g++"
+        def store():
+            os.makedirs(self.relative("work", "compiled"), exist_ok=True)
+            fetch_file(binary, self.compile_result(*args))
+            return [self.relative(*args)] + list(headers) + [TOOLCHAIN_PREFIX + lang] # same as __do_compile
+
+        self._job_cache.record_job("comp.{}".format(self._job_cache.safe_id_from_slist(list(args))), store)
+
     def compilation_result(self, *args):
         return self.compile_result(*args)
     
@@ -813,58 +975,101 @@ class Problem(ProblemBase):
             if interactive:
                 print(*args, **kwargs)
 
+        snapshot = self.snapshot()
+        previous = Snapshot.load(self.relative("work", "_snapshot.json"))
+        if snapshot == previous and self.exists("work", "tests") and self.exists("work", "testset"):
+            iprint("Tests are up to date")
+            return
+        if previous != None:
+            iprint("Changed: {}".format(", ".join(snapshot.changed(previous))))
+
         iprint("Running script")
         tests = self.get_testset()
-        generators = []
-        for test in tests:
-            if not test.is_manual():
-                for part in test.get_cmd_parts():
-                    if not part[0] in generators:
-                        generators.append(part[0])
-
-        iprint("Compiling generators")
-        for gen in generators:
-            if not self.exists("source", gen):
-                gen = gen + ".cpp"
-            iprint("Compiling source/" + gen)
-            self.compile("source", gen)
-    
-        iprint("Compiling checker")
-        self.compile(self._checker)
-        shutil.copyfile(self.compilation_result(self._checker), self.relative("work", "compiled", "check.cpp"))
-        iprint("Generating tests")
-        inputs = []
-        
+
+        # everything below is one graph: each test goes generator(s) -> validator -> model answer
+        # as soon as the programs it needs are compiled, independently of the other tests
+        graph = JobGraph(self._judge.get_capacity())
+        safe  = self._job_cache.safe_id_from_string
+
+        def job(job_id):
+            return lambda: self._job_cache.run_job(job_id)
+
+        def compile_node(*args):
+            # compilations are expensive, prefer the ones many tests are waiting for
+            return graph.add("comp." + self._job_cache.safe_id_from_slist(list(args)), lambda: self.compile(*args), weight=10)
+
+        def compile_checker():
+            self.compile(self._checker)
+            shutil.copyfile(self.compilation_result(self._checker), self.relative("work", "compiled", "check.cpp"))
+
+        graph.add("checker", compile_checker, weight=10)
+        validator = compile_node(self._validator) if self._validator else None
+        model     = compile_node("solutions", self._model_solution)
+
+        batches = dict() # python generator -> [[(mgen job id, args)]], see __do_mgen_batch
+        def batch_node(gen, job_id, args):
+            chunks = batches.setdefault(gen, [])
+            if not chunks or len(chunks[-1]) == Problem.FORK_SERVER_BATCH:
+                chunks.append([])
+            chunk = chunks[-1]
+            chunk.append((job_id, args))
+            return graph.add("batch.{}.{}".format(safe(gen), len(chunks)), lambda: self.__do_mgen_batch(gen, chunk),
+                             deps=[compile_node("source", gen)], weight=Problem.FORK_SERVER_BATCH)
+
+        # tests are posted as soon as they are ready, to the directory replacing work/tests in the end
+        staging = self.relative("work", "tests.new")
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+
+        def post(i, data, answer):
+            def func():
+                test_path = os.path.join(staging, "%.03d" % i)
+                fetch_file(self.relative("work", "_data", data), test_path)
+                fetch_file(self.relative("work", "_data", answer), test_path + ".a")
+            return func
+
+        done = [0]
+        def test_done(key, result):
+            done[0] += 1
+            iprint("Generating tests: {}/{}".format(done[0], len(set(answers))))
+
+        inputs  = []
+        answers = []
         for i in range(1, 1 + len(tests)):
             test = tests[i]
-            
+
             if test.is_manual():
-                self._job_cache.run_job("mtest.{}".format(self._job_cache.safe_id_from_string(test.get_manual_path())))
-                inputs.append("mtest.{}".format(self._job_cache.safe_id_from_string(test.get_manual_path())))
+                prev = graph.add("mtest.{}".format(safe(test.get_manual_path())), job("mtest.{}".format(safe(test.get_manual_path()))))
             else:
                 prev = ""
                 for cmd_ in test.get_cmd_parts():
                     cmd = list(cmd_) # copied
                     if not self.exists("source", cmd[0]):
                         cmd[0] = cmd[0] + ".cpp"
-                    cur = "mgen.{}.{}".format(self._job_cache.safe_id_from_string(prev), self._job_cache.safe_id_from_slist(cmd))
-                    self._job_cache.run_job(cur)
+                    cur = "mgen.{}.{}".format(safe(prev), self._job_cache.safe_id_from_slist(cmd))
+                    deps = [compile_node("source", cmd[0]), prev if prev != "" else None]
+                    if self._fork_server and prev == "" and cmd[0].endswith(".py") and not cur in graph:
+                        deps.append(batch_node(cmd[0], cur, cmd[1:]))
+                    graph.add(cur, job(cur), deps=deps)
                     prev = cur
-                inputs.append(prev)
-                
-            iprint("Generating tests: {}/{}".format(i, len(tests)))
+            inputs.append(prev)
 
-        iprint("Validating")
-        if self._validator:
-            self.compile(self._validator)
-            
-            for i in range(len(tests)):
-                group = ""
-                if tests[i + 1].has_group():
-                    group = tests[i + 1].get_group()
-                self._job_cache.run_job("val.{}.{}".format(self._job_cache.safe_id_from_string(group), inputs[i]))
+            if self._validator:
+                group = test.get_group() if test.has_group() else ""
+                val = "val.{}.{}".format(safe(group), prev)
+                graph.add(val, job(val), deps=[validator, prev])
 
-                
+            ans = "ans.{}.{}".format(safe(self._model_solution), safe(prev))
+            graph.add(ans, job(ans), deps=[model, prev], c_handler=test_done)
+            answers.append(ans)
+
+            graph.add("post.{}".format(i), post(i, prev, ans), deps=[prev, ans], weight=0)
+
+        iprint("Generating and validating tests, {} jobs".format(len(graph)))
+        graph.run()
+
+        if self._validator:
             bad = []
             for i in range(len(tests)):
                 if not self.get_validation(i + 1).is_ok():
@@ -879,34 +1084,23 @@ class Problem(ProblemBase):
         else:
             iprint("Validation skipped since there is no validator")
 
-
-        iprint("Compiling jury solution")
-        self.compile("solutions", self._model_solution)
-        iprint("Generating jury answers")
-        answers = []
-        for i in range(len(tests)):
-            self._job_cache.run_job("ans.{}.{}".format(self._job_cache.safe_id_from_string(self._model_solution), self._job_cache.safe_id_from_string(inputs[i])))
-            answers.append("ans.{}.{}".format(self._job_cache.safe_id_from_string(self._model_solution), self._job_cache.safe_id_from_string(inputs[i])))
-
         iprint("Posting tests")
         if os.path.exists(self.relative("work", "tests")):
             shutil.rmtree(self.relative("work", "tests"))
+        os.rename(staging, self.relative("work", "tests"))
 
-        os.makedirs(self.relative("work", "tests"), exist_ok=True)
-            
-        for i in range(len(tests)):
-            test_path = self.relative("work", "tests", "%.03d" % (i + 1))
-            
-            shutil.copyfile(self.relative("work", "_data", inputs[i]), test_path)
-            shutil.copyfile(self.relative("work", "_data", answers[i]), test_path + ".a")
-
+        # taken before the build: if something changed meanwhile, the next build sees it,
+        # except for the compilations' dependencies, which are only known after the build
+        parts = dict(snapshot.parts)
+        parts["compile deps"] = self._compile_deps_digest()
+        Snapshot(parts).save(self.relative("work", "_snapshot.json"))
         iprint("Done!")
 
     def wipe(self, mrpropper=False):
         if mrpropper:
             shutil.rmtree(self.relative("work"))
         else:
-            for part in ["compiled","_data", "_jobs", "tests", "testset"]:
+            for part in ["compiled","_data", "_jobs", "_stage", "tests", "tests.new", "testset", "_snapshot.json", "_state.db", "_state.db-wal", "_state.db-shm"]:
                 if os.path.isfile(self.relative("work", part)):
                     os.remove(self.relative("work", part))
                 elif os.path.isdir(self.relative("work", part)):
@@ -0,0 +1,74 @@
+"""
+Merkle-style fingerprint of the problem's inputs (see Problem.snapshot()).
+
+Every part (a file, a directory or any string, e.g. the compiler identity) gets a digest,
+a directory digest is a hash of it's entries' names and digests, the root is a hash of the parts.
+The snapshot of the last successful build is kept in work/_snapshot.json:
+if the root matches, nothing the tests depend on has changed.
+"""
+
+import os, os.path
+import hashlib
+import json
+
+def tree_digest(path, digests):
+    """
+    Digest of the file, or of the directory (recursively), digests: digests.DigestDB
+    """
+    if not os.path.isdir(path):
+        return digests.digest(path)
+
+    names = sorted(os.listdir(path))
+    items = digests.digests([os.path.join(path, name) for name in names if not os.path.isdir(os.path.join(path, name))])
+    items = iter(items)
+
+    hasher = hashlib.sha256(b"dir\n")
+    for name in names:
+        if os.path.isdir(os.path.join(path, name)):
+            digest = tree_digest(os.path.join(path, name), digests)
+        else:
+            digest = next(items)
+        hasher.update("{}\0{}\n".format(name, digest).encode())
+    return hasher.hexdigest()
+
+class Snapshot:
+    def __init__(self, parts):
+        """
+        parts: dict name -> digest
+        """
+        self.parts = dict(parts)
+
+        hasher = hashlib.sha256()
+        for name in sorted(self.parts):
+            hasher.update("{}\0{}\n".format(name, self.parts[name]).encode())
+        self.root = hasher.hexdigest()
+
+    def changed(self, other):
+        """
+        Returns the names of the parts, which differ from the other snapshot (all if it's None)
+        """
+        if other == None:
+            return sorted(self.parts)
+        names = set(self.parts) | set(other.parts)
+        return sorted(name for name in names if self.parts.get(name) != other.parts.get(name))
+
+    def __eq__(self, other):
+        return isinstance(other, Snapshot) and self.root == other.root
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump({"root": self.root, "parts": self.parts}, fp)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path):
+        """
+        Returns the saved snapshot or None
+        """
+        try:
+            with open(path, "r") as fp:
+                data = json.load(fp)
+            return Snapshot(data["parts"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None